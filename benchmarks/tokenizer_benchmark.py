@@ -0,0 +1,25 @@
+import os
+import timeit
+import book_classification as bc
+
+path_to_book = os.path.join(
+    os.path.dirname(__file__), "..", "book_classification", "tests", "pg1465.txt")
+
+
+def run(tokenizer, book):
+    for _ in tokenizer.tokens_from(book):
+        pass
+
+
+if __name__ == '__main__':
+    book = bc.DummyBook(open(path_to_book).read() * 10)
+    repeat, number = 5, 3
+
+    results = {}
+    for tokenizer in [bc.BasicTokenizer(), bc.FastTokenizer()]:
+        name = tokenizer.__class__.__name__
+        timer = timeit.Timer(lambda: run(tokenizer, book))
+        results[name] = min(timer.repeat(repeat, number)) / number
+        print("%-16s %.4f s per book" % (name, results[name]))
+
+    print("speedup: %.2fx" % (results['BasicTokenizer'] / results['FastTokenizer']))
@@ -1,7 +1,10 @@
 from .book import *
+from .corpus_store import *
 from .book_collection import *
+from .near_duplicates import *
 from .token_features import *
 from .book_features_extractors import *
+from .features_store import *
 from .classification import *
 from .tokenizer import *
 from .grouper import *
@@ -1,4 +1,6 @@
+import io
 import re
+import hashlib
 import zipfile
 import gzip
 import book_classification as bc
@@ -13,13 +15,14 @@ class DummyBook:
 
 
 class Book:
+    header_size = 8192
+
     def __init__(self, author, title, contents, source=None):
         self._author = author
         self._title = title
         self._contents = contents
         self._source = source
-        # TODO: migrate existing db, adding hash
-        #self._hash = hash(contents)
+        self._hash = None
 
     def author(self):
         return self._author
@@ -28,37 +31,113 @@ class Book:
         return self._title
 
     def contents(self):
+        if self._contents is None and self._source is not None:
+            self._contents = Book._read_file(self._source)
         return self._contents
 
     def source(self):
         return self._source
 
+    def text_chunks(self, chunk_size):
+        # pieces of the contents, straight from the file if they were not read yet
+        if self._contents is None and self._source is not None:
+            with Book._open_file(self._source) as f:
+                for chunk in iter(lambda: f.read(chunk_size), ''):
+                    yield chunk
+        else:
+            contents = self.contents()
+            for i in range(0, len(contents), chunk_size):
+                yield contents[i:i+chunk_size]
+
+    def is_lazy(self):
+        # contents still to be read from the source file
+        return self._contents is None and self._source is not None
+
+    def cached_content_hash(self):
+        return getattr(self, '_hash', None)
+
+    def set_content_hash(self, digest):
+        # for hashes of the same contents computed elsewhere, like a worker process
+        self._hash = digest
+
+    def content_hash(self):
+        # computed on first use; books pickled before this existed have no _hash at all
+        if getattr(self, '_hash', None) is None:
+            if self._contents is None and self._source is not None:
+                # lazy books are hashed from the file, without keeping the text
+                self._hash = Book._hash_file(self._source)
+            else:
+                self._hash = hashlib.sha1(self.contents().encode('utf-8')).hexdigest()
+        return self._hash
+
     @staticmethod
     def from_str(string, source=None):
         text = string
 
         try:
-            author = re.search('Author:\s+(.+)', string).group(1).rstrip()
-            title = re.search('Title:\s+(.+)', text).group(1).rstrip()
+            author, title = Book._header_from(text)
             return Book(author, title, text, source)
 
         except AttributeError:
             raise Exception("missing book information")
 
     @staticmethod
-    def from_file_path(file_name):
-        # TODO: partial/lazy read, much faster
+    def _header_from(text):
+        author = re.search('Author:\s+(.+)', text).group(1).rstrip()
+        title = re.search('Title:\s+(.+)', text).group(1).rstrip()
+        return author, title
+
+    @staticmethod
+    def from_file_path(file_name, lazy=False):
+        # lazy books read only the header now, and the rest on first contents()
+        if not lazy:
+            return Book.from_str(Book._read_file(file_name), file_name)
+
+        with Book._open_file(file_name) as f:
+            head = f.read(Book.header_size)
+        # a line cut by the end of the head could give a truncated title
+        if len(head) == Book.header_size:
+            head = head[:head.rfind('\n') + 1]
+        try:
+            author, title = Book._header_from(head.replace('\r\n', '\n'))
+        except AttributeError:
+            # not in the first few KB, look at all of it
+            return Book.from_str(Book._read_file(file_name), file_name)
+        return Book(author, title, None, file_name)
+
+    @staticmethod
+    def _open_file(file_name):
         if file_name.endswith(".zip"):
-            with zipfile.ZipFile(file_name) as zf:
-                assert len(zf.namelist()) == 1
-                with zf.open(zf.namelist()[0]) as f:
-                    return Book.from_str(str(f.read(), 'utf-8').replace('\r\n', '\n'), file_name)
+            zf = zipfile.ZipFile(file_name)
+            assert len(zf.namelist()) == 1
+            binary = zf.open(zf.namelist()[0])
+            # the member keeps the archive open after zf goes away
+            zf.close()
+            return io.TextIOWrapper(binary, 'utf-8', newline='')
         elif file_name.endswith(".gz"):
-            with gzip.open(file_name) as f:
-                return Book.from_str(str(f.read(), 'utf-8').replace('\r\n', '\n'), file_name)
+            return io.TextIOWrapper(gzip.open(file_name), 'utf-8', newline='')
         elif file_name.endswith(".txt"):
         # XXX: or use default case?
-            with open(file_name, "rU") as f:
-                return Book.from_str(f.read(), file_name)
+            return open(file_name, "r")
         else:
             raise Exception("unknown file extension for %s" % file_name)
+
+    @staticmethod
+    def _hash_file(file_name, chunk_size=2**16):
+        # same digest as hashing _read_file(file_name), a chunk at a time
+        digest = hashlib.sha1()
+        with Book._open_file(file_name) as f:
+            carry = ''
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                text = carry + chunk
+                # a '\r' at the end could be the first half of a '\r\n'
+                carry = '\r' if text.endswith('\r') else ''
+                text = text[:len(text) - len(carry)]
+                digest.update(text.replace('\r\n', '\n').encode('utf-8'))
+            digest.update(carry.encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _read_file(file_name):
+        with Book._open_file(file_name) as f:
+            return f.read().replace('\r\n', '\n')
@@ -1,14 +1,20 @@
-from collections import defaultdict, Counter
+from collections import defaultdict
 import book_classification as bc
 import random
+import os
+import time
+import concurrent.futures
 import pandas
 import numpy
+from scipy import sparse
 
 
 class BookCollection:
     def __init__(self, books, books_by_author):
         self._books = books
         self._books_by_author = books_by_author
+        self._author_codes = None
+        self._author_rows = None
 
     def __len__(self):
         return len(self._books)
@@ -22,6 +28,23 @@ class BookCollection:
     def authors(self):
         return self._books_by_author.keys()
 
+    def author_codes(self):
+        # a number per book telling its author, and the authors in order of appearance;
+        # collections pickled before this existed have no _author_codes at all
+        if getattr(self, '_author_codes', None) is None:
+            codes = {}
+            author_codes = numpy.fromiter(
+                (codes.setdefault(book.author(), len(codes)) for book in self.books()),
+                dtype=numpy.int64, count=len(self))
+            self._author_codes = (author_codes, list(codes))
+        return self._author_codes
+
+    def author_rows(self):
+        # positions in books() of the books of every author, in collection order
+        if getattr(self, '_author_rows', None) is None:
+            self._author_rows = _group_rows(*self.author_codes())
+        return self._author_rows
+
     def fold(self, func_author, func_book, base_author, base_book):
         final_result = base_author
         for author in self.authors():
@@ -47,120 +70,348 @@ class BookCollection:
 
     @classmethod
     def from_books(cls, books):
-        # XXX: book order need to be deterministic, if list of books is used to construct another collection
-        _books = list(books)
+        # sequences keep their order; sets have none that survives a run, so
+        # their books are sorted
+        if isinstance(books, (set, frozenset)):
+            _books = sorted(books, key=lambda b: (b.author(), b.title(), b.source() or ''))
+        else:
+            _books = list(books)
         _books_by_author = defaultdict(set)
         for b in _books:
             _books_by_author[b.author()].add(b)
         return cls(_books, _books_by_author)
 
     @classmethod
-    def from_file_path_list(cls, path_list):
-        books = [bc.Book.from_file_path(path) for path in path_list]
+    def from_file_path_list(cls, path_list, loader=None):
+        # without a loader the first bad file raises, like it always did
+        if loader is None:
+            loader = BookLoader(processes=1, keep_going=False)
+        books = [book for _, book in sorted(loader.load_indexed(path_list), key=lambda pair: pair[0])]
         return cls.from_books(books)
 
     @classmethod
-    def from_dataframe(cls, dataframe):
+    def from_dataframe(cls, dataframe, collection=None):
+        # rows of collection.as_dataframe() keep their index, which are the positions
+        # of their books in it
+        if collection is not None:
+            return BookCollectionView(collection, dataframe.index.values)
         return cls.from_books(dataframe['Object'])
 
+    @classmethod
+    def from_corpus_store(cls, path):
+        return cls.from_books(bc.CorpusStore.open(path).books())
+
+    def to_corpus_store(self, path):
+        return bc.CorpusStore.write(path, self.books())
+
+
+def _group_rows(codes, names):
+    order = numpy.argsort(codes, kind='stable')
+    bounds = numpy.cumsum(numpy.bincount(codes, minlength=len(names)))[:-1]
+    return dict(zip(names, numpy.split(order, bounds)))
+
+
+# loads books over a pool of processes (or threads), keeping at most
+# max_in_flight of them between being read and being consumed; books are
+# yielded as they finish, and files that fail are reported instead of
+# stopping the whole load
+class BookLoader:
+    def __init__(self, processes=None, threads=False, max_in_flight=None, lazy=False, keep_going=True):
+        self._processes = processes or os.cpu_count() or 1
+        self._threads = threads
+        self._max_in_flight = max_in_flight or 2 * self._processes
+        self._lazy = lazy
+        self._keep_going = keep_going
+        self._failures = []
+        self._books = 0
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def load(self, path_list):
+        for _, book in self.load_indexed(path_list):
+            yield book
+
+    def load_indexed(self, path_list):
+        # (position in path_list, book), in the order they finish
+        results = self._results(path_list)
+        try:
+            while True:
+                # only the time spent getting the next book counts, not the
+                # time the caller takes with the previous one
+                start = time.perf_counter()
+                try:
+                    result = next(results, None)
+                finally:
+                    self._seconds += time.perf_counter() - start
+                if result is None:
+                    return
+
+                index, path, book, size, error = result
+                self._bytes += size
+                if error is not None:
+                    if not self._keep_going:
+                        raise error
+                    self._failures.append((path, str(error)))
+                    continue
+                self._books += 1
+                yield index, book
+        finally:
+            results.close()
+
+    def _results(self, path_list):
+        jobs = ((index, path, self._lazy) for index, path in enumerate(path_list))
+        if self._processes == 1:
+            for job in jobs:
+                yield _load_book(job)
+            return
+
+        if self._threads:
+            executor = concurrent.futures.ThreadPoolExecutor(self._processes)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(self._processes)
+        with executor:
+            pending = set()
+            for job in jobs:
+                pending.add(executor.submit(_load_book, job))
+                if len(pending) >= self._max_in_flight:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+
+    def failures(self):
+        return list(self._failures)
+
+    def stats(self):
+        seconds = self._seconds or float('nan')
+        return {'books': self._books, 'failures': len(self._failures),
+            'bytes': self._bytes, 'seconds': self._seconds,
+            'books_per_second': self._books / seconds,
+            'megabytes_per_second': self._bytes / 2**20 / seconds}
+
+
+def _load_book(job):
+    index, path, lazy = job
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    try:
+        return index, path, bc.Book.from_file_path(path, lazy), size, None
+    except Exception as error:
+        return index, path, None, size, error
+
+
+# the books of a collection at some positions, without copying them into a
+# new collection; books and the grouping by author are built on first use
+class BookCollectionView(BookCollection):
+    def __init__(self, collection, rows):
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        # views of views point straight at the collection underneath
+        if isinstance(collection, BookCollectionView):
+            rows = collection._rows[rows]
+            collection = collection._collection
+        self._collection = collection
+        self._rows = rows
+        self._books = None
+        self._books_by_author = None
+        self._author_codes = None
+        self._author_rows = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def books(self):
+        if self._books is None:
+            books = self._collection.books()
+            self._books = [books[row] for row in self._rows]
+        return self._books
 
+    def books_by(self, author):
+        return self._grouping()[author]
+
+    def authors(self):
+        return self._grouping().keys()
+
+    def author_codes(self):
+        # the parent's numbers, no need to look at the books again
+        if self._author_codes is None:
+            codes, authors = self._collection.author_codes()
+            codes = codes[self._rows]
+            present, first = numpy.unique(codes, return_index=True)
+            present = present[numpy.argsort(first)]
+            renumber = numpy.zeros(len(authors), dtype=numpy.int64)
+            renumber[present] = numpy.arange(len(present))
+            self._author_codes = (renumber[codes], [authors[code] for code in present])
+        return self._author_codes
+
+    def _grouping(self):
+        if self._books_by_author is None:
+            books = self.books()
+            self._books_by_author = dict((author, set(books[row] for row in rows))
+                for author, rows in self.author_rows().items())
+        return self._books_by_author
+
+    def collection(self):
+        return self._collection
+
+    def rows(self):
+        return self._rows
+
+
+# statistics from one binary book x word matrix, built on first use
 class BookCollectionAnalysis:
     def __init__(self, book_collection, tokenizer):
         self._book_collection = book_collection
         self._tokenizer = tokenizer
-        extractor = bc.VocabulariesExtractor(self._tokenizer)
-        self._vocabulary = bc.CollectionHierarchialFeatures.from_book_collection(
-            self._book_collection, extractor)
+        self._vocabulary = None
+        self._matrix = None
+        self._author_matrix = None
 
     def vocabulary(self):
+        if self._vocabulary is None:
+            extractor = bc.VocabulariesExtractor(self._tokenizer)
+            self._vocabulary = bc.CollectionHierarchialFeatures.from_book_collection(
+                self._book_collection, extractor)
         return self._vocabulary
 
-    def shared_words_by_books(self):
-        books_for_word = Counter()
-        for book in self._book_collection.books():
-            for word in self._vocabulary.by_book(book).keys():
-                books_for_word[word] += 1
+    def matrix(self):
+        # rows are books, in collection order; token ids (or tokens interned
+        # here) are columns
+        if self._matrix is None:
+            interner = bc.TokenInterner()
+            rows = []
+            for book in self._book_collection.books():
+                tokens = self._tokenizer.tokens_from(book)
+                if not isinstance(tokens, numpy.ndarray):
+                    tokens = interner.intern_all(tokens)
+                rows.append(numpy.unique(tokens))
+
+            indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(row) for row in rows], out=indptr[1:])
+            indices = numpy.concatenate([numpy.zeros(0, dtype=numpy.int32)] + rows)
+            num_words = max(len(interner), indices.max() + 1 if len(indices) > 0 else 0)
+            self._matrix = sparse.csr_matrix(
+                (numpy.ones(len(indices), dtype=numpy.int32), indices, indptr),
+                shape=(len(rows), num_words))
+        return self._matrix
+
+    def author_matrix(self):
+        # rows are authors, in the order of authors(); a one where any of their books has the word
+        if self._author_matrix is None:
+            codes, authors = self._book_collection.author_codes()
+            indicator = sparse.csr_matrix(
+                (numpy.ones(len(codes), dtype=numpy.int32), (codes, numpy.arange(len(codes)))),
+                shape=(len(authors), len(codes)))
+            matrix = (indicator @ self.matrix()).tocsr()
+            matrix.data[:] = 1
+            self._author_matrix = matrix
+        return self._author_matrix
+
+    @staticmethod
+    def _word_count_by_n(matrix):
+        # how many words appear in exactly n rows, for every n that happens
+        rows_for_word = numpy.bincount(matrix.indices, minlength=matrix.shape[1])
+        word_count_by_n = numpy.bincount(rows_for_word)
+        present = numpy.flatnonzero(word_count_by_n[1:]) + 1
+        return pandas.Series(word_count_by_n[present], index=pandas.Index(present, name="n"),
+            name="Words")
 
-        word_count_by_n = Counter()
-        for word, count in books_for_word.items():
-            word_count_by_n[count] += 1
-
-        return word_count_by_n
+    def shared_words_by_books(self):
+        return self._word_count_by_n(self.matrix())
 
     def shared_words_by_authors(self):
-        authors_for_word = Counter()
-        for author in self._book_collection.authors():
-            for word in self._vocabulary.by_author(author).keys():
-                authors_for_word[word] += 1
+        return self._word_count_by_n(self.author_matrix())
 
-        word_count_by_n = Counter()
-        for word, count in authors_for_word.items():
-            word_count_by_n[count] += 1
-
-        return word_count_by_n
+    def vocabulary_size(self):
+        # words in any book; ids from a shared interner may leave empty columns
+        matrix = self.matrix()
+        return numpy.count_nonzero(numpy.bincount(matrix.indices, minlength=matrix.shape[1]))
 
     def vocabulary_size_by_book(self):
-        result = []
-        for book in self._book_collection.books():
-            unique_words = len(self._vocabulary.by_book(book))
-            result.append([book, unique_words])
-        return pandas.DataFrame(result, columns=["Book", "Unique words"])
+        sizes = numpy.diff(self.matrix().indptr)
+        return pandas.DataFrame({"Book": self._book_collection.books(), "Unique words": sizes},
+            columns=["Book", "Unique words"])
 
     def vocabulary_size_by_author(self):
-        result = []
-        for author in self._book_collection.authors():
-            unique_words = len(self._vocabulary.by_author(author))
-            result.append([author, unique_words])
-        return pandas.DataFrame(result, columns=["Author", "Unique words"])
+        sizes = numpy.diff(self.author_matrix().indptr)
+        authors = self._book_collection.author_codes()[1]
+        return pandas.DataFrame({"Author": authors, "Unique words": sizes},
+            columns=["Author", "Unique words"])
 
 
 class BookCollectionSelection:
     def __init__(self, book_collection):
         self._book_collection = book_collection
 
+    def _first_of_titles(self):
+        seen = set()
+        first = numpy.zeros(len(self._book_collection), dtype=bool)
+        for i, book in enumerate(self._book_collection.books()):
+            if book.title() not in seen:
+                seen.add(book.title())
+                first[i] = True
+        return first
+
     def find_duplicates(self):
-        dataframe = self._book_collection.as_dataframe()
-        duplicates = dataframe[dataframe.duplicated('Title')]
-        return BookCollection.from_dataframe(duplicates)
+        return self._view(numpy.flatnonzero(~self._first_of_titles()))
 
     def remove_duplicates(self):
-        dataframe = self._book_collection.as_dataframe()
-        return BookCollection.from_dataframe(dataframe.drop_duplicates('Title'))
+        return self._view(numpy.flatnonzero(self._first_of_titles()))
+
+    def _near_duplicate_rows(self, threshold, hasher):
+        if hasher is None:
+            hasher = bc.MinHasher(bc.FastTokenizer())
+        index = bc.LshIndex(hasher.num_permutations(), threshold)
+        for book in self._book_collection.books():
+            index.add(hasher.signature_for(book))
+        return index.clusters()
+
+    def find_near_duplicates(self, threshold=0.8, hasher=None):
+        # groups of books whose shingles are about threshold alike (Jaccard), at least
+        books = self._book_collection.books()
+        return [[books[row] for row in rows] for rows in self._near_duplicate_rows(threshold, hasher)]
+
+    def remove_near_duplicates(self, threshold=0.8, hasher=None):
+        # only the first book of every group stays
+        keep = numpy.ones(len(self._book_collection), dtype=bool)
+        for rows in self._near_duplicate_rows(threshold, hasher):
+            keep[rows[1:]] = False
+        return self._view(numpy.flatnonzero(keep))
+
+    def _view(self, rows):
+        rows = numpy.sort(numpy.asarray(rows, dtype=numpy.int64))
+        return BookCollectionView(self._book_collection, rows)
+
+    def _rows_of(self, authors):
+        author_rows = self._book_collection.author_rows()
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] +
+            [author_rows[author] for author in authors])
 
     def filter_authors(self, condition):
-        result = []
-        for author in self._book_collection.authors():
-            for book in self._book_collection.books_by(author):
-                if condition(author):
-                    result.append(book)
-        return BookCollection.from_books(result)
+        return self._view(self._rows_of(filter(condition, self._book_collection.authors())))
 
     def filter_books(self, condition):
-        return BookCollection.from_books(
-            filter(condition, self._book_collection.books()))
+        books = self._book_collection.books()
+        return self._view([i for i, book in enumerate(books) if condition(book)])
 
     def partition_books(self, condition):
-        books_one = set()
-        books_two = set()
-
-        for b in self._book_collection.books():
-            if condition(b):
-                books_one.add(b)
-            else:
-                books_two.add(b)
-
-        c1 = BookCollection.from_books(books_one)
-        c2 = BookCollection.from_books(books_two)
-        return c1, c2
+        mask = numpy.fromiter(map(condition, self._book_collection.books()),
+            dtype=bool, count=len(self._book_collection))
+        return self._view(numpy.flatnonzero(mask)), self._view(numpy.flatnonzero(~mask))
 
     def exclude_authors_below(self, n):
+        author_rows = self._book_collection.author_rows()
         def condition(author):
-            return len(self._book_collection.books_by(author)) >= n
+            return len(author_rows[author]) >= n
         return self.filter_authors(condition)
 
     def exclude_authors_above(self, n):
+        author_rows = self._book_collection.author_rows()
         def condition(author):
-            return len(self._book_collection.books_by(author)) <= n
+            return len(author_rows[author]) <= n
         return self.filter_authors(condition)
 
     def split_per_author_number(self, n):
@@ -176,8 +427,8 @@ class BookCollectionSelection:
         assert(0 < percentage < 1)
 
         author_sizes = {}
-        for author in self._book_collection.authors():
-            n = len(self._book_collection.books_by(author))
+        for author, rows in self._book_collection.author_rows().items():
+            n = len(rows)
             author_sizes[author] = min(n-1, round(percentage*n))
 
         return self.split_per_author_with_sizes(author_sizes)
@@ -188,40 +439,35 @@ class BookCollectionSelection:
         #    if size < 2:
         #        raise Exception("can not partition author '%s' with less than 2 books" % author)
 
-        def condition(book):
-            author = book.author()
-            if quantities[author] > 0:
-                quantities[author] -= 1
-                return True
-            else:
-                return False
-        return self.partition_books(condition)
+        # the first books of every author, in collection order
+        first = [numpy.zeros(0, dtype=numpy.int64)]
+        rest = [numpy.zeros(0, dtype=numpy.int64)]
+        for author, rows in self._book_collection.author_rows().items():
+            n = max(0, quantities[author])
+            first.append(rows[:n])
+            rest.append(rows[n:])
+        return self._view(numpy.concatenate(first)), self._view(numpy.concatenate(rest))
 
     def sample_authors(self, n):
         authors = random.sample(list(self._book_collection.authors()), n)
-        return self.filter_authors(lambda x: x in authors)
+        return self._view(self._rows_of(authors))
 
     def sample_books(self, n):
-        books = random.sample(list(self._book_collection.books()), n)
-        return self.filter_books(lambda x: x in books)
+        return self._view(random.sample(range(len(self._book_collection)), n))
 
     def sample_books_per_author(self, n):
         result = []
-        for author in self._book_collection.authors():
-            books = self._book_collection.books_by(author)
-            result.extend(random.sample(list(books), n))
-        return self.filter_books(lambda x: x in result)
+        for rows in self._book_collection.author_rows().values():
+            result.extend(random.sample(rows.tolist(), n))
+        return self._view(result)
 
     def sample_authors_with_books(self, num_authors, num_books):
-        seq = self._book_collection.authors()
-        cond = lambda author: len(self._book_collection.books_by(author)) >= num_books
-        authors = list(filter(cond, seq))
+        author_rows = self._book_collection.author_rows()
+        authors = [author for author, rows in author_rows.items() if len(rows) >= num_books]
 
         authors = random.sample(authors, num_authors)
-        books = []
+        result = []
         for a in authors:
-            author_books = list(self._book_collection.books_by(a))
-            selected_books = random.sample(author_books, num_books)
-            books.extend(selected_books)
+            result.extend(random.sample(author_rows[a].tolist(), num_books))
 
-        return BookCollection.from_books(books)
+        return self._view(result)
@@ -1,21 +1,36 @@
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict
 import math
+import sys
 import book_classification as bc
-import shelve
+import numpy
+from scipy import sparse
 
 
 class Extractor:
     def extract_from(self, book):
         raise NotImplementedError()
 
+    def interner(self):
+        return bc.interner_of(self._tokenizer)
+
+    def token_key_arrays(self):
+        # names of the arrays of its features that hold tokens, see Features.to_arrays
+        return ['keys']
+
 
 class VocabulariesExtractor(Extractor):
     def __init__(self, tokenizer):
         self._tokenizer = tokenizer
 
     def extract_from(self, book):
+        return self.extract_from_tokens(self._tokenizer.tokens_from(book))
+
+    def extract_from_tokens(self, tokens):
+        if isinstance(tokens, numpy.ndarray):
+            return bc.ArrayTokenVocabularies(self, numpy.unique(tokens))
+
         data = {}
-        for token in self._tokenizer.tokens_from(book):
+        for token in tokens:
             data[token] = True
         return bc.TokenVocabularies(self, data)
 
@@ -25,27 +40,43 @@ class FrequenciesExtractor(Extractor):
         self._tokenizer = tokenizer
 
     def extract_from(self, book):
+        return self.extract_from_tokens(self._tokenizer.tokens_from(book))
+
+    def extract_from_tokens(self, tokens):
+        if isinstance(tokens, numpy.ndarray):
+            return self._extract_from_ids(tokens)
+
         entries = Counter()
         total = 0
-        for token in self._tokenizer.tokens_from(book):
+        for token in tokens:
             entries[token] += 1
             total += 1
         for token in entries.keys():
             entries[token] /= total
         return bc.TokenFrequencies(self, entries, total)
 
+    def _extract_from_ids(self, ids):
+        total = len(ids)
+        counts = numpy.bincount(ids)
+        present = numpy.flatnonzero(counts)
+        return bc.ArrayTokenFrequencies(self, present, counts[present] / total, total)
+
 
 class SeriesExtractor(Extractor):
     def __init__(self, tokenizer):
         self._tokenizer = tokenizer
 
     def extract_from(self, book):
-        series = defaultdict(list)
-        total_tokens = 0
-        for index, token in enumerate(self._tokenizer.tokens_from(book)):
-            series[token].append(index)
-            total_tokens += 1
-        return bc.TokenSeries(self, series, total_tokens)
+        return self.extract_from_tokens(self._tokenizer.tokens_from(book))
+
+    def extract_from_tokens(self, tokens):
+        if isinstance(tokens, numpy.ndarray):
+            return bc.TokenSeries.from_ids(self, tokens)
+
+        # number the tokens locally, in order of appearance
+        indices = {}
+        ids = numpy.fromiter((indices.setdefault(token, len(indices)) for token in tokens), dtype=numpy.int64)
+        return bc.TokenSeries.from_ids(self, ids, list(indices.keys()))
 
 
 class EntropiesExtractor(Extractor):
@@ -54,7 +85,17 @@ class EntropiesExtractor(Extractor):
         self._grouper = grouper
 
     def extract_from(self, book):
-        parts = self._grouper.parts_from(self._tokenizer.tokens_from(book))
+        return self.extract_from_tokens(self._tokenizer.tokens_from(book))
+
+    def extract_from_tokens(self, tokens):
+        if isinstance(self._grouper, bc.SlidingGrouper):
+            return self._extract_from_sliding(tokens)
+        if isinstance(tokens, numpy.ndarray):
+            if isinstance(self._grouper, bc.FixedGrouper):
+                return self._extract_from_fixed_ids(tokens)
+            tokens = tokens.tolist()
+
+        parts = self._grouper.parts_from(tokens)
         frequencies_extractor = FrequenciesExtractor(bc.DummySequenceTokenizer())
         frequencies_list = (frequencies_extractor.extract_from(p) for p in parts)
 
@@ -70,47 +111,296 @@ class EntropiesExtractor(Extractor):
 
         return bc.TokenEntropies(self, sum_freqs, sum_freqs_log, total)
 
+    def _extract_from_fixed_ids(self, ids):
+        # one (part x token) count matrix for all the parts, then sum by token
+        size = self._grouper.parts_size()
+        num_parts = -(-len(ids) // size)
+        if num_parts == 0:
+            return bc.ArrayTokenEntropies(self, [], [], [], 0)
+
+        parts = numpy.arange(len(ids)) // size
+        counts = sparse.csr_matrix(
+            (numpy.ones(len(ids)), (parts, ids)), shape=(num_parts, ids.max() + 1))
+        counts.sum_duplicates()
+
+        parts_sizes = numpy.full(num_parts, size)
+        parts_sizes[-1] = len(ids) - size*(num_parts - 1)
+        freqs = counts.data / numpy.repeat(parts_sizes, numpy.diff(counts.indptr))
+
+        # rows are sorted, so each token adds its parts in the same order as the loop above
+        sum_freqs = numpy.bincount(counts.indices, freqs)
+        sum_freqs_log = numpy.bincount(counts.indices, freqs * numpy.log(freqs))
+        present = numpy.unique(counts.indices)
+        return bc.ArrayTokenEntropies(self, present, sum_freqs[present], sum_freqs_log[present], num_parts)
+
+    def _extract_from_sliding(self, tokens):
+        # windows overlap, so follow each token's count as the window slides
+        # instead of counting every window again
+        ids = isinstance(tokens, numpy.ndarray)
+        if not ids:
+            tokens = list(tokens)
+
+        size = self._grouper.parts_size()
+        sum_freqs = Counter()
+        sum_freqs_log = Counter()
+
+        for token, count, windows in self._grouper.count_spans_from(tokens):
+            v = count / size
+            sum_freqs[token] += windows * v
+            sum_freqs_log[token] += windows * v * math.log(v)
+
+        total = max(0, len(tokens) - size + 1)
+        if ids:
+            return bc.ArrayTokenEntropies.from_dicts(self, sum_freqs, sum_freqs_log, total)
+        return bc.TokenEntropies(self, sum_freqs, sum_freqs_log, total)
+
+
+# n-grams hashed straight to one of 2**num_bits columns, with no vocabulary to
+# fit or keep; another bit of the hash picks the sign, so colliding n-grams
+# cancel out on average instead of always adding up. Values are frequencies,
+# keyed by column
+class HashingExtractor(Extractor):
+    _prime = numpy.uint64(1099511628211)
+    _column_mix = numpy.uint64(0x9e3779b97f4a7c15)
+    _sign_mix = numpy.uint64(0xc2b2ae3d27d4eb4f)
+
+    def __init__(self, tokenizer, ngram_range=(1, 1), num_bits=18, signed=True):
+        assert(1 <= ngram_range[0] <= ngram_range[1])
+        assert(1 <= num_bits <= 31)
+        self._tokenizer = tokenizer
+        self._ngram_range = tuple(ngram_range)
+        self._num_bits = num_bits
+        self._signed = signed
+
+    def num_columns(self):
+        return 2**self._num_bits
+
+    def token_key_arrays(self):
+        # keyed by column, tokens are gone
+        return []
+
+    def extract_from(self, book):
+        return self.extract_from_tokens(self._tokenizer.tokens_from(book))
+
+    def extract_from_tokens(self, tokens):
+        columns, values, total = self._hashed(tokens)
+        return bc.ArrayTokenFrequencies(self, columns, values, total)
+
+    def row_from(self, book):
+        columns, values, _ = self._hashed(self._tokenizer.tokens_from(book))
+        return columns, values
+
+    def matrix_for(self, collection):
+        # one row per book, in collection order, like an encoded collection
+        builder = bc.SparseRowsBuilder(len(collection), self.num_columns())
+        for book in collection.books():
+            builder.append_row(*self.row_from(book))
+        return builder.tocsr().tocsc()
+
+    def _hashed(self, tokens):
+        # words are hashed, never ids, so columns are the same in every process
+        token_hashes = bc.token_hashes(tokens, bc.interner_of(self._tokenizer))
+        total = len(token_hashes)
+        hashes = [numpy.zeros(0, dtype=numpy.uint64)]
+        for n in range(self._ngram_range[0], min(self._ngram_range[1], total) + 1):
+            # starting from n keeps an n-gram apart from the same tokens with fewer ones
+            h = numpy.full(total - n + 1, n, dtype=numpy.uint64)
+            for j in range(n):
+                h = h * self._prime + token_hashes[j:total - n + 1 + j]
+            hashes.append(h)
+        hashes = numpy.concatenate(hashes)
 
+        columns = ((hashes * self._column_mix) >> numpy.uint64(64 - self._num_bits)).astype(numpy.int32)
+        if self._signed:
+            signs = numpy.where((hashes * self._sign_mix) >> numpy.uint64(63), -1.0, 1.0)
+        else:
+            signs = numpy.ones(len(hashes))
+        present, inverse = numpy.unique(columns, return_inverse=True)
+        values = numpy.bincount(inverse, weights=signs, minlength=len(present))
+        return present, values / max(total, 1), total
+
+
+# tokenizes each book once and hands the same tokens to every registered extractor
+class MultiExtractor(Extractor):
+    def __init__(self, tokenizer, extractors=None):
+        self._tokenizer = tokenizer
+        self._extractors = {}
+        for name, extractor in (extractors or {}).items():
+            self.register(name, extractor)
+
+    def register(self, name, extractor):
+        if name in self._extractors:
+            raise ValueError("extractor '%s' is already registered" % name)
+        # they get this extractor's tokens, their own tokenizer would never run
+        if getattr(extractor, '_tokenizer', None) is not self._tokenizer:
+            raise ValueError("extractor '%s' does not use the tokenizer of the MultiExtractor" % name)
+        self._extractors[name] = extractor
+        return self
+
+    def extract_from(self, book):
+        tokens = self._tokenizer.tokens_from(book)
+        if not isinstance(tokens, numpy.ndarray):
+            tokens = list(tokens)
+
+        features = {}
+        for name, extractor in self._extractors.items():
+            features[name] = extractor.extract_from_tokens(tokens)
+        return bc.MultiFeatures(self, features)
+
+    def names(self):
+        return self._extractors.keys()
+
+    def extractor_for(self, name):
+        return self._extractors[name]
+
+    def token_key_arrays(self):
+        return ['%s/%s' % (name, key) for name, extractor in self._extractors.items()
+            for key in extractor.token_key_arrays()]
+
+
+# keeps features in memory, optionally bounded by number of entries and/or
+# approximate bytes, evicting the least recently ('lru') or least frequently
+# ('lfu') used; books are keyed by contents, so equal books share an entry
 class CachedExtractorWrapper:
-    def __init__(self, extractor):
+    def __init__(self, extractor, max_entries=None, max_bytes=None, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("unknown eviction policy '%s'" % policy)
+
         self._extractor = extractor
-        self._cache = {}
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._policy = policy
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self._uses = Counter()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
 
     def extract_from(self, book):
-        if book not in self._cache:
-            self._cache[book] = self._extractor.extract_from(book)
+        key = self._key_for(book)
+        if key in self._cache:
+            self._hits += 1
+            self._uses[key] += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self._misses += 1
+        features = self._extractor.extract_from(book)
+        self._cache[key] = features
+        self._uses[key] = 1
+        if self._max_bytes is not None:
+            self._sizes[key] = approximate_size(features)
+            self._bytes += self._sizes[key]
+        self._shrink()
+
+        return features
+
+    def _key_for(self, book):
+        if hasattr(book, 'content_hash'):
+            return book.content_hash()
+        return book
+
+    def _shrink(self):
+        # the entry just added stays, even if it is bigger than the limit
+        while len(self._cache) > 1 and self._over_limits():
+            if self._policy == 'lru':
+                key = next(iter(self._cache))
+            else:
+                # ties go to the least recently used, which comes first
+                key = min(self._cache, key=self._uses.__getitem__)
 
-        return self._cache[book]
+            del self._cache[key]
+            del self._uses[key]
+            self._bytes -= self._sizes.pop(key, 0)
+            self._evictions += 1
+
+    def _over_limits(self):
+        if self._max_entries is not None and len(self._cache) > self._max_entries:
+            return True
+        return self._max_bytes is not None and self._bytes > self._max_bytes
+
+    def stats(self):
+        return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+            'entries': len(self._cache), 'bytes': self._bytes}
+
+    def clear(self):
+        self._cache.clear()
+        self._sizes.clear()
+        self._uses.clear()
+        self._bytes = 0
+
+    def interner(self):
+        return bc.interner_of(self._extractor)
+
+    def token_key_arrays(self):
+        return self._extractor.token_key_arrays()
+
+    def fingerprint_state(self):
+        return self._extractor
+
+
+# rough memory use of features: containers and their contents, but not the
+# extractor they point to, which is shared
+def approximate_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, numpy.ndarray):
+        return sys.getsizeof(obj) if obj.base is None else obj.nbytes
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approximate_size(k, seen) + approximate_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += approximate_size(x, seen)
+    elif isinstance(obj, bc.Features):
+        for name, value in vars(obj).items():
+            if name != '_extractor':
+                size += approximate_size(value, seen)
+    return size
 
 
 class PersistentExtractorWrapper:
-    def __init__(self, extractor, name):
+    def __init__(self, extractor, name, max_size=None):
         self._extractor = extractor
         self._name = name
-        self._cache = shelve.open(name)
+        self._cache = bc.FeaturesStore(name, max_size)
+        # fingerprinting is slow for big extractors (large vocabularies), do it once
+        self._fingerprint = bc.fingerprint(extractor)
 
     def extract_from(self, book):
-        key = book.title()
-        if key not in self._cache:
-            self._cache[key] = self._extractor.extract_from(book)
+        features = self._cache.load(self._extractor, book, self._fingerprint)
+        if features is None:
+            features = self._extractor.extract_from(book)
+            self._cache.save(self._extractor, book, features, self._fingerprint)
 
-        return self._cache[key]
+        return features
 
-    def close(self):
-        self._cache.close()
+    def stats(self):
+        return self._cache.stats()
 
+    def interner(self):
+        return bc.interner_of(self._extractor)
 
-class PersistentExtractorWrapper2:
-    def __enter__(self, extractor, name):
-        self._extractor = extractor
-        self._name = name
-        self._cache = shelve.open(name)
+    def token_key_arrays(self):
+        return self._extractor.token_key_arrays()
 
-    def extract_from(self, book):
-        if book not in self._cache:
-            self._cache[book] = self._extractor.extract_from(book)
+    def fingerprint_state(self):
+        return self._extractor
+
+    def close(self):
+        # nothing stays open between calls, kept for compatibility
+        pass
 
-        return self._cache[book]
+    def __enter__(self):
+        return self
 
     def __exit__(self, type, value, traceback):
-        self._cache.close()
+        self.close()
@@ -1,5 +1,9 @@
 import book_classification as bc
 import random
+import multiprocessing
+import hashlib
+import json
+import os
 
 
 class ClassificationModel:
@@ -10,11 +14,10 @@ class ClassificationModel:
 
     def fit(self, collection):
         self._training = collection
-        self._collection_matrix_extractor = bc.CollectionFeaturesMatrixExtractor(
-            self._extractor, self._training)
+        self._collection_matrix_extractor = self._matrix_extractor_for(self._training)
         self._authors_indexer = bc.NumericIndexer(self._training.authors())
 
-        matrix = self._collection_matrix_extractor.extract_from(self._training)
+        matrix = self._collection_matrix_extractor.training_matrix()
         authors = self.encode_authors(self._training)
 
         reduced_matrix = self._dim_reducer.fit_transform(matrix)
@@ -36,6 +39,25 @@ class ClassificationModel:
     def decode_authors(self, sequence):
         return [self._authors_indexer.decode(author) for author in sequence]
 
+    def _matrix_extractor_for(self, training):
+        return bc.CollectionFeaturesMatrixExtractor(self._extractor, training)
+
+
+# for experiments with many trials over the same books: features are extracted
+# once for the whole collection, and each fit only slices them
+class PrecomputedClassificationModel(ClassificationModel):
+    def __init__(self, precomputed, dim_reducer, classifier):
+        ClassificationModel.__init__(self, None, dim_reducer, classifier)
+        self._precomputed = precomputed
+
+    @classmethod
+    def for_collection(cls, extractor, collection, dim_reducer, classifier):
+        precomputed = bc.PrecomputedCollectionFeatures(extractor, collection)
+        return cls(precomputed, dim_reducer, classifier)
+
+    def _matrix_extractor_for(self, training):
+        return self._precomputed.matrix_extractor_for(training)
+
 
 class ClassificationModelFixedVoc:
     def __init__(self, extractor, dim_reducer, classifier, vocabulary):
@@ -96,138 +118,199 @@ class ClassificationResults:
         return sum(len(self._collection.books_by(a)/len(self._collection))**2 for a in self._collection.authors())
 
 
-class ExperimentSeries:
-    pass
+# runs the trials of an experiment series, one after the other or over a process
+# pool; with a master seed every trial gets its own seed derived from it and
+# its position, so results don't depend on the number of processes or on the
+# order trials finish, and finished trials can be kept in a checkpoint file
+class TrialScheduler:
+    def __init__(self, processes=1, master_seed=None, checkpoint=None):
+        if master_seed is None and (processes > 1 or checkpoint is not None):
+            raise ValueError("parallel or resumable trials need a master seed")
+
+        self._processes = processes
+        self._master_seed = master_seed
+        self._checkpoint = checkpoint
+
+    def seed_for(self, step_index, trial_index):
+        key = repr((self._master_seed, step_index, trial_index)).encode('utf-8')
+        return int(hashlib.sha1(key).hexdigest()[:8], 16)
+
+    def run(self, experiment, config, steps, num_trials):
+        results = self._load_checkpoint(experiment, config)
+        tasks = []
+        for i, step in enumerate(steps):
+            for j in range(num_trials):
+                if (i, j) not in results:
+                    tasks.append((i, j, step, self._seed_or_none(i, j)))
+
+        if self._processes > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(
+                self._processes, initializer=_initialize_trial_worker, initargs=(experiment, config))
+            try:
+                for i, j, result in pool.imap_unordered(_run_trial_in_worker, tasks):
+                    results[i, j] = result
+                    self._save_checkpoint(experiment, config, results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                i, j, result = _run_trial(experiment, config, task)
+                results[i, j] = result
+                self._save_checkpoint(experiment, config, results)
+
+        return [[results[i, j] for j in range(num_trials)] for i in range(len(steps))]
+
+    def _seed_or_none(self, step_index, trial_index):
+        if self._master_seed is None:
+            return None
+        return self.seed_for(step_index, trial_index)
+
+    def _checkpoint_header(self, experiment, config):
+        return {'experiment': experiment.__class__.__name__,
+            'config': sorted(config.items()), 'seed': self._master_seed}
+
+    def _load_checkpoint(self, experiment, config):
+        if self._checkpoint is None or not os.path.exists(self._checkpoint):
+            return {}
+
+        with open(self._checkpoint) as f:
+            data = json.load(f)
+        header = json.loads(json.dumps(self._checkpoint_header(experiment, config)))
+        if data['header'] != header:
+            raise ValueError("checkpoint %s belongs to another experiment" % self._checkpoint)
+
+        return dict(((i, j), result) for i, j, result in data['results'])
+
+    def _save_checkpoint(self, experiment, config, results):
+        if self._checkpoint is None:
+            return
+
+        data = {'header': self._checkpoint_header(experiment, config),
+            'results': [[i, j, result] for (i, j), result in sorted(results.items())]}
+        temporary = self._checkpoint + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, self._checkpoint)
+
+
+def _run_trial(experiment, config, task):
+    i, j, step, seed = task
+    if seed is None:
+        return i, j, experiment.run_trial(config, step)
+    with bc.RandomContext(seed):
+        return i, j, experiment.run_trial(config, step)
+
+
+# set once per worker process by the pool initializer
+_trial_worker_state = None
+
+
+def _initialize_trial_worker(experiment, config):
+    global _trial_worker_state
+    _trial_worker_state = (experiment, config)
+
+
+def _run_trial_in_worker(task):
+    experiment, config = _trial_worker_state
+    return _run_trial(experiment, config, task)
+
 
+class ExperimentSeries:
+    required_options = []
 
-class ESOverAuthorsCount:
-    def __init__(self, book_collection, classification_model):
+    def __init__(self, book_collection, classification_model, scheduler=None):
         self._book_collection = book_collection
         self._classification_model = classification_model
+        self._scheduler = scheduler or TrialScheduler()
 
     def run_experiment(self, config):
-        for key in ['num_books', 'training_percentage', 'num_trials', 'num_authors']:
+        for key in self.required_options:
             if key not in config:
                 raise Exception('missing required option %s' % key)
 
-        num_books = config['num_books']
-        collection = self._book_collection.selection().exclude_authors_below(num_books)
-        total_authors = len(collection.authors())
-
-        results = []
-        for num_authors in range(2, min(total_authors+1, config['num_authors'])):
-            current_results = []
+        return self._scheduler.run(self, config, self.steps(config), config['num_trials'])
 
-            for _ in range(config['num_trials']):
-                current_collection = collection.selection().sample_authors_with_books(num_authors, num_books)
-                training, testing = current_collection.selection().split_per_author_percentage(config['training_percentage'])
-                self._classification_model.fit(training)
-                metric = self._classification_model.predict(testing).metric()
-                current_results.append(metric)
+    def steps(self, config):
+        raise NotImplementedError()
 
-            results.append(current_results)
+    def run_trial(self, config, step):
+        raise NotImplementedError()
 
-        return results
+    def _metric_for(self, collection, percentage):
+        training, testing = collection.selection().split_per_author_percentage(percentage)
+        self._classification_model.fit(training)
+        return self._classification_model.predict(testing).metric()
 
+    def _min_accuracy_for(self, collection):
+        return sum((len(collection.books_by(a))/len(collection))**2 for a in collection.authors())
 
-class ESOverBiasedAuthorsCount:
-    def __init__(self, book_collection, classification_model):
-        self._book_collection = book_collection
-        self._classification_model = classification_model
 
-    def run_experiment(self, config):
-        for key in ['min_books', 'training_percentage', 'num_trials', 'num_authors']:
-            if key not in config:
-                raise Exception('missing required option %s' % key)
+class ESOverAuthorsCount(ExperimentSeries):
+    required_options = ['num_books', 'training_percentage', 'num_trials', 'num_authors']
 
-        collection = self._book_collection.selection().exclude_authors_below(config['min_books'])
+    def steps(self, config):
+        collection = self._book_collection.selection().exclude_authors_below(config['num_books'])
         total_authors = len(collection.authors())
+        return list(range(2, min(total_authors+1, config['num_authors'])))
 
-        results = []
-        min_acc = []
-        for num_authors in range(2, min(total_authors+1, config['num_authors'])):
-            current_results = []
-            current_min_acc = []
-
-            for _ in range(config['num_trials']):
-                current_collection = collection.selection().sample_authors(num_authors)
-                training, testing = current_collection.selection().split_per_author_percentage(config['training_percentage'])
-                self._classification_model.fit(training)
-                metric = self._classification_model.predict(testing).metric()
-                current_results.append(metric)
-                current_min_acc.append(sum((len(current_collection.books_by(a))/len(current_collection))**2 for a in current_collection.authors()))
-
-            results.append(current_results)
-            min_acc.append(current_min_acc)
+    def run_trial(self, config, num_authors):
+        collection = self._book_collection.selection().exclude_authors_below(config['num_books'])
+        current_collection = collection.selection().sample_authors_with_books(num_authors, config['num_books'])
+        return self._metric_for(current_collection, config['training_percentage'])
 
-        self._min_acc = min_acc
-        return results
 
-    def min_acc(self):
-        return self._min_acc
-
-
-class ESOverTrainingProportion:
-    def __init__(self, book_collection, classification_model):
-        self._book_collection = book_collection
-        self._classification_model = classification_model
+class ESOverBiasedAuthorsCount(ExperimentSeries):
+    required_options = ['min_books', 'training_percentage', 'num_trials', 'num_authors']
 
     def run_experiment(self, config):
-        for key in ['num_books', 'num_steps', 'num_trials', 'num_authors']:
-            if key not in config:
-                raise Exception('missing required option %s' % key)
-
-        results = []
-        for i in range(1, config['num_steps']):
-            percentage = i/config['num_steps']
+        results = ExperimentSeries.run_experiment(self, config)
+        self._min_acc = [[min_acc for _, min_acc in trials] for trials in results]
+        return [[metric for metric, _ in trials] for trials in results]
 
-            trial_results = []
-            for _ in range(config['num_trials']):
-                collection = self._book_collection.selection().sample_authors_with_books(
-                    config['num_authors'], config['num_books'])
+    def steps(self, config):
+        collection = self._book_collection.selection().exclude_authors_below(config['min_books'])
+        total_authors = len(collection.authors())
+        return list(range(2, min(total_authors+1, config['num_authors'])))
 
-                training, testing = collection.selection().split_per_author_percentage(percentage)
-                self._classification_model.fit(training)
-                metric = self._classification_model.predict(testing).metric()
-                trial_results.append(metric)
+    def run_trial(self, config, num_authors):
+        collection = self._book_collection.selection().exclude_authors_below(config['min_books'])
+        current_collection = collection.selection().sample_authors(num_authors)
+        metric = self._metric_for(current_collection, config['training_percentage'])
+        return metric, self._min_accuracy_for(current_collection)
 
-            results.append(trial_results)
+    def min_acc(self):
+        return self._min_acc
 
-        return results
 
+class ESOverTrainingProportion(ExperimentSeries):
+    required_options = ['num_books', 'num_steps', 'num_trials', 'num_authors']
 
-class ESOverBiasedTrainingProportion:
-    def __init__(self, book_collection, classification_model):
-        self._book_collection = book_collection
-        self._classification_model = classification_model
+    def steps(self, config):
+        return [i/config['num_steps'] for i in range(1, config['num_steps'])]
 
-    def run_experiment(self, config):
-        for key in ['min_books', 'num_authors', 'num_steps', 'num_trials']:
-            if key not in config:
-                raise Exception('missing required option %s' % key)
+    def run_trial(self, config, percentage):
+        collection = self._book_collection.selection().sample_authors_with_books(
+            config['num_authors'], config['num_books'])
+        return self._metric_for(collection, percentage)
 
-        results = []
-        min_acc = []
-        for i in range(1, config['num_steps']):
-            percentage = i/config['num_steps']
 
-            trial_results = []
-            current_min_acc = []
-            for _ in range(config['num_trials']):
-                collection = self._book_collection.selection().exclude_authors_below(config['min_books'])
-                collection = collection.selection().sample_authors(config['num_authors'])
-                training, testing = collection.selection().split_per_author_percentage(percentage)
+class ESOverBiasedTrainingProportion(ExperimentSeries):
+    required_options = ['min_books', 'num_authors', 'num_steps', 'num_trials']
 
-                self._classification_model.fit(training)
-                metric = self._classification_model.predict(testing).metric()
-                trial_results.append(metric)
-                current_min_acc.append(sum((len(collection.books_by(a))/len(collection))**2 for a in collection.authors()))
+    def run_experiment(self, config):
+        results = ExperimentSeries.run_experiment(self, config)
+        self._min_acc = [[min_acc for _, min_acc in trials] for trials in results]
+        return [[metric for metric, _ in trials] for trials in results]
 
-            results.append(trial_results)
-            min_acc.append(current_min_acc)
+    def steps(self, config):
+        return [i/config['num_steps'] for i in range(1, config['num_steps'])]
 
-        self._min_acc = min_acc
-        return results
+    def run_trial(self, config, percentage):
+        collection = self._book_collection.selection().exclude_authors_below(config['min_books'])
+        collection = collection.selection().sample_authors(config['num_authors'])
+        metric = self._metric_for(collection, percentage)
+        return metric, self._min_accuracy_for(collection)
 
     def min_acc(self):
         return self._min_acc
@@ -1,6 +1,8 @@
 import book_classification as bc
 from scipy import sparse
-from functools import reduce
+import numpy
+import numbers
+import multiprocessing
 from collections import defaultdict
 
 
@@ -16,6 +18,14 @@ class CollectionFeatures:
     def by_book(self, book):
         return self._features_by_book[book]
 
+    def component(self, name):
+        # for features from a MultiExtractor
+        features_by_book = {}
+        for book, features in self._features_by_book.items():
+            features_by_book[book] = features[name]
+
+        return self.__class__(self._collection, self._collection_extractor, features_by_book)
+
     def select(self, filter_pred):
         features_by_book = defaultdict(dict)
         for book, features in self._features_by_book.items():
@@ -52,38 +62,103 @@ class CollectionHierarchialFeatures:
 
         num_rows = len(self._by_author)
         num_cols = len(vocabulary)
-        matrix = sparse.dok_matrix((num_rows, num_cols))
+        capacity = sum(len(features) for features in self._by_author.values())
+        builder = SparseRowsBuilder(num_rows, num_cols, capacity)
 
-        for i, features in enumerate(self._by_author.values()):
-            for j, v in encoder.encode(features):
-                matrix[i, j] = v
+        for features in self._by_author.values():
+            builder.append_row(*encoder.encode_arrays(features))
 
-        return matrix.tocsc()
+        return builder.tocsr().tocsc()
 
     @classmethod
-    def from_book_collection(cls, collection, extractor):
+    def from_book_collection(cls, collection, extractor, processes=1):
         features_by_book = {}
         for book in collection.books():
             features_by_book[book] = extractor.extract_from(book)
-        features_by_author = {}
-        for author in collection.authors():
-            features = (features_by_book[book] for book in collection.books_by(author))
-            features_by_author[author] = reduce(lambda x,y: x.combine(y), features)
-        features_total = reduce(lambda x,y: x.combine(y), features_by_author.values())
+
+        authors = list(collection.authors())
+        features_lists = [[features_by_book[book] for book in collection.books_by(author)]
+            for author in authors]
+        if processes > 1:
+            combined = _combine_all_in_pool(extractor, features_lists, processes)
+        else:
+            combined = [combine_all(features_list) for features_list in features_lists]
+
+        features_by_author = dict(zip(authors, combined))
+        features_total = combine_all(features_by_author.values())
 
         return cls(extractor, features_by_book, features_by_author, features_total)
 
 
+def combine_all(features_list):
+    features_list = list(features_list)
+    if len(features_list) == 0:
+        raise ValueError("nothing to combine")
+    return type(features_list[0]).combine_all(features_list)
+
+
+def _combine_all_to_arrays(features_list):
+    return bc.features_to_arrays(combine_all(features_list))
+
+
+def _combine_all_in_pool(extractor, features_lists, processes):
+    # results come back as arrays and are rebuilt here, so they point to this
+    # extractor and not to a copy of it
+    with multiprocessing.Pool(processes) as pool:
+        all_arrays = pool.map(_combine_all_to_arrays, features_lists)
+
+    return [bc.features_from_arrays(extractor, arrays) for arrays in all_arrays]
+
+
 class FeaturesEncoder:
     def __init__(self, vocabulary):
         self._vocabulary = vocabulary
         self._numeric_indexer = bc.NumericIndexer(self._vocabulary)
 
+        # token ids (see TokenInterner) are encoded with a plain lookup table;
+        # other integer keys can be negative or spread far apart, those go
+        # through the indexer
+        self._lookup = None
+        ids = self._numeric_indexer.vocabulary()
+        if self._are_token_ids(ids):
+            self._lookup = numpy.full(max(ids) + 1, -1, dtype=numpy.int32)
+            self._lookup[numpy.array(ids, dtype=numpy.int64)] = numpy.arange(len(ids), dtype=numpy.int32)
+
+    @staticmethod
+    def _are_token_ids(ids):
+        if len(ids) == 0 or not all(isinstance(k, numbers.Integral) for k in ids):
+            return False
+        # an interner numbers words from 0 up, a vocabulary uses a good part of them
+        return min(ids) >= 0 and max(ids) < 8 * len(ids) + 2**16
+
     def encode(self, features):
         for k, v in features.items():
             if self._numeric_indexer.can_encode(k):
                 yield self._numeric_indexer.encode(k), v
 
+    def encode_arrays(self, features):
+        if self._lookup is not None:
+            return self._encode_ids(features)
+
+        indices = []
+        values = []
+        for j, v in self.encode(features):
+            indices.append(j)
+            values.append(v)
+        return numpy.array(indices, dtype=numpy.int32), numpy.array(values, dtype=numpy.float64)
+
+    def _encode_ids(self, features):
+        if isinstance(features, bc.MixinFeaturesArrays):
+            keys = features.keys_array().astype(numpy.int64)
+            values = features.values_array().astype(numpy.float64)
+        else:
+            keys = numpy.fromiter(features.keys(), dtype=numpy.int64, count=len(features))
+            values = numpy.fromiter(features.values(), dtype=numpy.float64, count=len(features))
+        known = (keys >= 0) & (keys < len(self._lookup))
+        indices = self._lookup[keys[known]]
+        encoded = indices >= 0
+        return indices[encoded], values[known][encoded]
+
     def decode(self, items):
         for k, v in items:
             yield self._numeric_indexer.decode(k), v
@@ -92,24 +167,66 @@ class FeaturesEncoder:
         return self._numeric_indexer.vocabulary()
 
 
+# builds the CSR arrays directly, row by row, instead of filling a dok_matrix cell by cell
+class SparseRowsBuilder:
+    def __init__(self, num_rows, num_cols, capacity=0):
+        self._shape = (num_rows, num_cols)
+        self._num_rows = 0
+        self._indptr = numpy.zeros(num_rows + 1, dtype=numpy.int64)
+        self._indices = numpy.empty(max(capacity, 1), dtype=numpy.int32)
+        self._data = numpy.empty(max(capacity, 1), dtype=numpy.float64)
+
+    def append_row(self, indices, values):
+        if self._num_rows >= self._shape[0]:
+            raise ValueError("all %d rows were already appended" % self._shape[0])
+
+        start = self._indptr[self._num_rows]
+        end = start + len(indices)
+        if end > len(self._indices):
+            self._grow(end)
+
+        self._indices[start:end] = indices
+        self._data[start:end] = values
+        self._num_rows += 1
+        self._indptr[self._num_rows] = end
+
+    def tocsr(self, keep_zeros=False):
+        if self._num_rows != self._shape[0]:
+            raise ValueError("expected %d rows, got %d" % (self._shape[0], self._num_rows))
+
+        nnz = self._indptr[-1]
+        matrix = sparse.csr_matrix(
+            (self._data[:nnz], self._indices[:nnz], self._indptr), shape=self._shape)
+        # same result as going through dok_matrix, which never stores zeros
+        if not keep_zeros:
+            matrix.eliminate_zeros()
+        matrix.sort_indices()
+        return matrix
+
+    def _grow(self, size):
+        capacity = max(size, 2*len(self._indices))
+        self._indices = numpy.resize(self._indices, capacity)
+        self._data = numpy.resize(self._data, capacity)
+
+
 class CollectionFeaturesEncoder:
     def __init__(self, encoder):
         self._encoder = encoder
 
     def encode(self, features):
+        books = features.collection().books()
         num_rows = len(features.collection())
         num_cols = len(self._encoder.vocabulary())
-        matrix = sparse.dok_matrix((num_rows, num_cols))
+        capacity = sum(len(features.by_book(book)) for book in books)
+        builder = SparseRowsBuilder(num_rows, num_cols, capacity)
 
-        for i, book in enumerate(features.collection().books()):
-            book_features = features.by_book(book)
-            for j, v in self._encoder.encode(book_features):
-                matrix[i, j] = v
+        for book in books:
+            builder.append_row(*self._encoder.encode_arrays(features.by_book(book)))
 
-        return matrix.tocsc()
+        return builder.tocsr().tocsc()
 
     def vocabulary(self):
-        return self._features_encoder.vocabulary()
+        return self._encoder.vocabulary()
 
 
 class CachedCollectionFeaturesEncoder:
@@ -126,27 +243,118 @@ class CachedCollectionFeaturesEncoder:
         for book in features.collection().books():
             if book.title() not in self._cache:
                 book_features = features.by_book(book)
-                matrix_row = sparse.dok_matrix((1, num_cols))
+                builder = SparseRowsBuilder(1, num_cols, len(book_features))
+                builder.append_row(*self._encoder.encode_arrays(book_features))
 
-                for j, v in self._encoder.encode(book_features):
-                    matrix_row[0, j] = v
-
-                self._cache[book.title()] = matrix_row.tocsr()
+                self._cache[book.title()] = builder.tocsr()
 
             rows.append(self._cache[book.title()])
 
         return sparse.vstack(rows, format='csr')
 
     def vocabulary(self):
-        return self._features_encoder.vocabulary()
+        return self._encoder.vocabulary()
 
 
 class CollectionFeaturesMatrixExtractor:
     def __init__(self, extractor, base_collection):
-        self._extractor = bc.CollectionFeaturesExtractor(extractor)
         self._training = base_collection
-        self._encoder = self._extractor.encoder_for(self._training)
+        # hashed features have fixed columns, there is no vocabulary to fit
+        if isinstance(extractor, bc.HashingExtractor):
+            self._extractor = extractor
+            self._encoder = None
+            self._training_matrix = extractor.matrix_for(self._training)
+            return
+
+        self._extractor = bc.CollectionFeaturesExtractor(extractor)
+        self._encoder, self._training_matrix = self._extractor.encoder_and_matrix_for(self._training)
 
     def extract_from(self, collection):
+        # the base collection was already encoded while building the vocabulary
+        if collection is self._training:
+            return self._training_matrix
+
+        if self._encoder is None:
+            return self._extractor.matrix_for(collection)
         features = self._extractor.extract_from(collection)
         return self._encoder.encode(features)
+
+    def training_matrix(self):
+        return self._training_matrix
+
+    def encoder(self):
+        return self._encoder
+
+
+# features of every book in a collection, extracted once and encoded over the
+# whole vocabulary; matrices for any sub-collection are then row and column
+# slices, with the same vocabulary and columns as extracting it again
+class PrecomputedCollectionFeatures:
+    def __init__(self, extractor, collection, collection_extractor=None):
+        if collection_extractor is None:
+            collection_extractor = bc.CollectionFeaturesExtractor(extractor)
+
+        features = collection_extractor.extract_from(collection)
+        vocabulary = set()
+        for book in collection.books():
+            vocabulary.update(features.by_book(book).keys())
+        self._encoder = bc.FeaturesEncoder(vocabulary)
+
+        books = list(collection.books())
+        self._collection = collection
+        self._rows = dict((book, i) for i, book in enumerate(books))
+        capacity = sum(len(features.by_book(book)) for book in books)
+        builder = SparseRowsBuilder(len(books), len(self._encoder.vocabulary()), capacity)
+        for book in books:
+            builder.append_row(*self._encoder.encode_arrays(features.by_book(book)))
+        # explicit zeros still tell which words a book has
+        self._matrix = builder.tocsr(keep_zeros=True)
+
+    def rows_for(self, collection):
+        # selections of the precomputed collection already know their rows
+        if collection is self._collection:
+            return numpy.arange(len(self._rows), dtype=numpy.int64)
+        if isinstance(collection, bc.BookCollectionView) and collection.collection() is self._collection:
+            return collection.rows()
+        try:
+            return numpy.array([self._rows[book] for book in collection.books()], dtype=numpy.int64)
+        except KeyError:
+            raise KeyError("book not in the precomputed collection")
+
+    def columns_for(self, collection):
+        return numpy.unique(self._matrix[self.rows_for(collection)].indices)
+
+    def matrix_for(self, collection, columns):
+        matrix = self._matrix[self.rows_for(collection)][:, columns]
+        matrix.eliminate_zeros()
+        return matrix.tocsc()
+
+    def matrix_extractor_for(self, training):
+        return PrecomputedMatrixExtractor(self, training)
+
+    def vocabulary(self):
+        return self._encoder.vocabulary()
+
+    def matrix(self):
+        return self._matrix
+
+
+# same interface as CollectionFeaturesMatrixExtractor, over precomputed features
+class PrecomputedMatrixExtractor:
+    def __init__(self, precomputed, base_collection):
+        self._precomputed = precomputed
+        self._training = base_collection
+        self._columns = self._precomputed.columns_for(self._training)
+        self._training_matrix = self._precomputed.matrix_for(self._training, self._columns)
+
+    def extract_from(self, collection):
+        if collection is self._training:
+            return self._training_matrix
+        return self._precomputed.matrix_for(collection, self._columns)
+
+    def training_matrix(self):
+        return self._training_matrix
+
+    def vocabulary(self):
+        vocabulary = self._precomputed.vocabulary()
+        return [vocabulary[j] for j in self._columns]
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 import book_classification as bc
 
 
@@ -13,14 +14,22 @@ class SerialCollectionFeaturesExtractor:
         return bc.CollectionFeatures(collection, self, result)
 
     def encoder_for(self, collection):
-        vocabulary = set()
+        return encoder_for_features(self.extract_from(collection))
+
+    def encoder_and_matrix_for(self, collection):
+        # a single extraction gives both the vocabulary and the training matrix
         features = self.extract_from(collection)
+        encoder = encoder_for_features(features)
+        return encoder, encoder.encode(features)
+
 
-        for book in features.collection().books():
-            vocabulary.update(features.by_book(book).keys())
+def encoder_for_features(features):
+    vocabulary = set()
+    for book in features.collection().books():
+        vocabulary.update(features.by_book(book).keys())
 
-        encoder = bc.FeaturesEncoder(vocabulary)
-        return bc.CollectionFeaturesEncoder(encoder)
+    encoder = bc.FeaturesEncoder(vocabulary)
+    return bc.CollectionFeaturesEncoder(encoder)
 
 
 class CollectionFeaturesFilteringExtractor:
@@ -33,40 +42,117 @@ class CollectionFeaturesFilteringExtractor:
         return features.select(self._filter_predicate)
 
 
-# XXX: multiprocessing module doesn't accept nested functions or lambdas
-class ExtractorClosure:
-    def __init__(self, extractor):
-        self._extractor = extractor
+# set once per worker process by the pool initializer, instead of pickling
+# the extractor along with every task
+_worker_extractor = None
+
+
+def _initialize_worker(extractor):
+    global _worker_extractor
+    _worker_extractor = extractor
+
 
-    def __call__(self, book):
-        return self._extractor.extract_from(book)
+def _extract_in_worker(job):
+    # returns the arrays and the hash of the contents, or None when the file
+    # changed since the parent loaded it, and the parent sends the book itself
+    book, source, content_hash = job
+    if book is None:
+        book = bc.Book.from_file_path(source)
+        if content_hash is not None and book.content_hash() != content_hash:
+            return None
+
+    arrays = bc.features_to_arrays(_worker_extractor.extract_from(book))
+
+    # ids from the worker's copy of the interner mean nothing to the parent
+    interner = bc.interner_of(_worker_extractor)
+    if interner is not None:
+        for name in _worker_extractor.token_key_arrays():
+            arrays[name] = interner.decode_all(arrays[name].tolist())
+    return arrays, book.content_hash()
 
 
 class ParallelCollectionFeaturesExtractor:
-    def __init__(self, extractor):
+    def __init__(self, extractor, processes=None, chunksize=None):
         self._extractor = extractor
+        self._processes = processes or multiprocessing.cpu_count()
+        self._chunksize = chunksize
+        self._pool = None
 
     def extract_from(self, collection):
         all_books = list(collection.books())
-        pool = multiprocessing.Pool()
+        jobs = [self._job_for(book) for book in all_books]
 
-        func = ExtractorClosure(self._extractor)
-        all_features = pool.map(func, all_books)
+        chunksize = self._chunksize
+        if chunksize is None:
+            chunksize = max(1, len(jobs) // (4*self._processes))
 
+        interner = bc.interner_of(self._extractor)
         result = {}
-        for book, features in zip(all_books, all_features):
-            result[book] = features
+        changed = []
+        for book, done in zip(all_books, self.pool().imap(_extract_in_worker, jobs, chunksize)):
+            if done is None:
+                changed.append(book)
+                continue
+            arrays, content_hash = done
+            # lazy books are hashed by the worker that read them, not here
+            if book.cached_content_hash() is None:
+                book.set_content_hash(content_hash)
+            result[book] = self._features_from(arrays, interner)
+
+        jobs = [(book, None, None) for book in changed]
+        for book, (arrays, _) in zip(changed, self.pool().imap(_extract_in_worker, jobs, chunksize)):
+            result[book] = self._features_from(arrays, interner)
         return bc.CollectionFeatures(collection, self, result)
 
-    def encoder_for(self, collection):
-        vocabulary = set()
-        features = self.extract_from(collection)
+    def _features_from(self, arrays, interner):
+        if interner is not None:
+            for name in self._extractor.token_key_arrays():
+                arrays[name] = interner.intern_all(arrays[name])
+        return bc.features_from_arrays(self._extractor, arrays)
+
+    def _job_for(self, book):
+        # books loaded from a file are read again by the worker, instead of
+        # pickling their whole contents
+        source = getattr(book, 'source', lambda: None)()
+        if source is None or not os.path.exists(source):
+            return book, None, None
+        # a lazy book is whatever its file holds now, there is nothing to check
+        # against; others must still match the contents the parent has
+        if book.is_lazy() and book.cached_content_hash() is None:
+            return None, source, None
+        return None, source, book.content_hash()
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self._processes, initializer=_initialize_worker, initargs=(self._extractor,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
 
-        for book in features.collection().books():
-            vocabulary.update(features.by_book(book).keys())
+    def encoder_for(self, collection):
+        return encoder_for_features(self.extract_from(collection))
 
-        encoder = bc.FeaturesEncoder(vocabulary)
-        return bc.CollectionFeaturesEncoder(encoder)
+    def encoder_and_matrix_for(self, collection):
+        # a single extraction gives both the vocabulary and the training matrix
+        features = self.extract_from(collection)
+        encoder = encoder_for_features(features)
+        return encoder, encoder.encode(features)
 
 
 CollectionFeaturesExtractor = SerialCollectionFeaturesExtractor
@@ -0,0 +1,147 @@
+import os
+import mmap
+import codecs
+import hashlib
+import numpy
+import book_classification as bc
+
+
+# a whole corpus as one file with the UTF-8 text of every book one after the
+# other, plus an index with where each book starts and its metadata; the text
+# is memory mapped, so opening a store reads only the index
+class CorpusStore:
+    _text_name = 'text.bin'
+    _index_name = 'index.npz'
+    # stores opened in this process by path, so books unpickled one at a time
+    # share one index instead of loading it each
+    _opened = {}
+
+    def __init__(self, path):
+        self._path = path
+        with numpy.load(os.path.join(path, self._index_name), allow_pickle=False) as index:
+            self._offsets = index['offsets']
+            self._authors = index['authors']
+            self._titles = index['titles']
+            self._hashes = index['hashes']
+            self._sources = index['sources']
+        self._file = None
+        self._text = None
+
+    @classmethod
+    def open(cls, path):
+        key = os.path.abspath(path)
+        if key not in cls._opened:
+            cls._opened[key] = cls(path)
+        return cls._opened[key]
+
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._titles)
+
+    def text(self):
+        # mapped on first use, the operating system pages it in as needed
+        if self._text is None:
+            if self._offsets[-1] == 0:
+                self._text = b''
+            else:
+                self._file = open(os.path.join(self._path, self._text_name), 'rb')
+                self._text = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._text
+
+    def view_of(self, i):
+        return memoryview(self.text())[self._offsets[i]:self._offsets[i+1]]
+
+    def contents_of(self, i):
+        return str(self.view_of(i), 'utf-8')
+
+    def book(self, i):
+        return StoredBook(self, i)
+
+    def books(self):
+        return [self.book(i) for i in range(len(self))]
+
+    def author_of(self, i):
+        return str(self._authors[i])
+
+    def title_of(self, i):
+        return str(self._titles[i])
+
+    def hash_of(self, i):
+        return str(self._hashes[i])
+
+    def source_of(self, i):
+        return str(self._sources[i]) or None
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._text.close()
+            except BufferError:
+                # views of books are still alive, the map goes away with the last of them
+                pass
+            self._file.close()
+        self._file = None
+        self._text = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __reduce__(self):
+        return CorpusStore.open, (self._path,)
+
+    @classmethod
+    def write(cls, path, books):
+        # books are consumed one at a time, only the index is kept in memory
+        os.makedirs(path, exist_ok=True)
+        offsets = [0]
+        authors = []
+        titles = []
+        hashes = []
+        sources = []
+        with open(os.path.join(path, cls._text_name), 'wb') as f:
+            for book in books:
+                data = book.contents().encode('utf-8')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+                authors.append(book.author())
+                titles.append(book.title())
+                hashes.append(hashlib.sha1(data).hexdigest())
+                sources.append(book.source() or '')
+
+        numpy.savez(os.path.join(path, cls._index_name),
+            offsets=numpy.array(offsets, dtype=numpy.int64),
+            authors=numpy.array(authors, dtype=str),
+            titles=numpy.array(titles, dtype=str),
+            hashes=numpy.array(hashes, dtype=str),
+            sources=numpy.array(sources, dtype=str))
+        store = cls._opened[os.path.abspath(path)] = cls(path)
+        return store
+
+
+# metadata is copied from the index, the contents are decoded from the
+# mapped text every time they are asked for and never kept
+class StoredBook(bc.Book):
+    def __init__(self, store, index):
+        super().__init__(store.author_of(index), store.title_of(index), None, store.source_of(index))
+        self._store = store
+        self._index = index
+        self._hash = store.hash_of(index)
+
+    def contents(self):
+        return self._store.contents_of(self._index)
+
+    def view(self):
+        return self._store.view_of(self._index)
+
+    def text_chunks(self, chunk_size):
+        # chunk_size is in bytes here, a character cut in two waits in the decoder
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        view = self.view()
+        for i in range(0, len(view), chunk_size):
+            yield decoder.decode(view[i:i+chunk_size])
+        yield decoder.decode(b'', final=True)
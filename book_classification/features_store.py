@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy
+import book_classification as bc
+
+
+# one .npz file per (extractor configuration, book contents), so duplicate
+# titles don't collide and changing any extractor parameter misses the cache;
+# files are written to a temporary name and renamed, which is atomic, so
+# several processes can share a store
+class FeaturesStore:
+    # when over max_size, entries go until this fraction of it is left, so
+    # that the next writes don't all have to scan the store again
+    low_water = 0.9
+
+    def __init__(self, path, max_size=None):
+        self._path = path
+        self._max_size = max_size
+        self._size = None
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evictions = 0
+        os.makedirs(self._path, exist_ok=True)
+
+    # fingerprinting a big extractor is slow, callers can pass bc.fingerprint(extractor)
+    def path_for(self, extractor, book, fingerprint=None):
+        digest = book.content_hash()
+        fingerprint = fingerprint or bc.fingerprint(extractor)
+        return os.path.join(self._path, fingerprint, digest[:2], digest + '.npz')
+
+    def load(self, extractor, book, fingerprint=None):
+        path = self.path_for(extractor, book, fingerprint)
+        try:
+            with numpy.load(path, allow_pickle=False) as data:
+                arrays = dict(data.items())
+            # keep recently used entries away from eviction
+            os.utime(path)
+        except (FileNotFoundError, zipfile.BadZipFile, EOFError, ValueError):
+            self._misses += 1
+            return None
+
+        self._hits += 1
+        return bc.features_from_arrays(extractor, arrays)
+
+    def save(self, extractor, book, features, fingerprint=None):
+        path = self.path_for(extractor, book, fingerprint)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        arrays = bc.features_to_arrays(features)
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                numpy.savez(f, **arrays)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+        self._writes += 1
+        if self._max_size is not None:
+            if self._size is None:
+                self._size = self.size()
+            self._size += os.path.getsize(path)
+            if self._size > self._max_size:
+                self.evict(int(self._max_size * self.low_water))
+
+    def entries(self):
+        # (path, size, last use) for every stored entry
+        result = []
+        for directory, _, files in os.walk(self._path):
+            for name in files:
+                if not name.endswith('.npz'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result.append((path, stat.st_size, stat.st_mtime))
+        return result
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_size):
+        # least recently used first, other processes may be evicting too
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+                self._evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(0)
+
+    def stats(self):
+        return {'hits': self._hits, 'misses': self._misses,
+            'writes': self._writes, 'evictions': self._evictions}
+
+
+# token series kept as plain .npy files, one directory per book, so they can
+# be memory mapped: opening the series of a whole corpus reads only the keys
+class SeriesStore:
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(self._path, exist_ok=True)
+
+    def path_for(self, extractor, book, fingerprint=None):
+        digest = book.content_hash()
+        fingerprint = fingerprint or bc.fingerprint(extractor)
+        return os.path.join(self._path, fingerprint, digest[:2], digest)
+
+    def __contains__(self, pair):
+        extractor, book = pair
+        return self._complete(self.path_for(extractor, book))
+
+    def _complete(self, path):
+        return os.path.exists(os.path.join(path, 'total.npy'))
+
+    def save(self, extractor, book, series, fingerprint=None):
+        path = self.path_for(extractor, book, fingerprint)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        temporary = tempfile.mkdtemp(suffix='.tmp', dir=directory)
+        try:
+            series.save(temporary)
+            os.replace(temporary, path)
+        except OSError:
+            # somebody else stored the same contents first
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+
+    def load(self, extractor, book, mmap_mode='r', fingerprint=None):
+        path = self.path_for(extractor, book, fingerprint)
+        if not self._complete(path):
+            return None
+        return bc.TokenSeries.load(extractor, path, mmap_mode)
+
+    def series_for(self, extractor, collection, mmap_mode='r'):
+        # extracts and stores what is missing; everything else stays on disk
+        # until its positions are used
+        fingerprint = bc.fingerprint(extractor)
+        for book in collection.books():
+            series = self.load(extractor, book, mmap_mode, fingerprint)
+            if series is None:
+                self.save(extractor, book, extractor.extract_from(book), fingerprint)
+                series = self.load(extractor, book, mmap_mode, fingerprint)
+            yield book, series
@@ -1,3 +1,7 @@
+from collections import deque
+import numpy
+
+
 class Grouper:
     def parts_from(self, sequence):
         raise NotImplementedError()
@@ -16,6 +20,11 @@ class FixedGrouper(Grouper):
         self._parts_size = parts_size
 
     def parts_from(self, sequence):
+        if isinstance(sequence, numpy.ndarray):
+            return (sequence[i:i+self._parts_size] for i in range(0, len(sequence), self._parts_size))
+        return self._lists_from(sequence)
+
+    def _lists_from(self, sequence):
         group = []
         for token in sequence:
             if len(group) >= self._parts_size:
@@ -34,13 +43,62 @@ class SlidingGrouper(Grouper):
         self._parts_size = parts_size
 
     def parts_from(self, sequence):
-        window = []
+        if isinstance(sequence, numpy.ndarray):
+            return iter(self.windows_from(sequence))
+        return self._lists_from(sequence)
+
+    def _lists_from(self, sequence):
+        window = deque(maxlen=self._parts_size)
         for element in sequence:
             window.append(element)
             if len(window) >= self._parts_size:
                 # need to copy because it is changed later
                 yield list(window)
-                window.pop(0)
+
+    def windows_from(self, array):
+        # one row per window, all of them read-only views over the same array
+        array = numpy.asarray(array)
+        if len(array) < self._parts_size:
+            return numpy.empty((0, self._parts_size), dtype=array.dtype)
+        return numpy.lib.stride_tricks.sliding_window_view(array, self._parts_size)
+
+    def count_spans_from(self, sequence):
+        # yields (token, count, windows): token appears count times in each of
+        # that many consecutive windows; every step only updates the entering
+        # and leaving tokens, so the total cost is linear in the sequence length
+        if isinstance(sequence, numpy.ndarray):
+            sequence = sequence.tolist()
+
+        window = deque()
+        counts = {}
+        since = {}
+        current = 0
+
+        for element in sequence:
+            if len(window) < self._parts_size:
+                window.append(element)
+                counts[element] = counts.get(element, 0) + 1
+                since[element] = 0
+                continue
+
+            leaving = window.popleft()
+            window.append(element)
+            current += 1
+            if leaving == element:
+                continue
+
+            for token, delta in ((leaving, -1), (element, 1)):
+                count = counts.get(token, 0)
+                if count > 0 and current > since[token]:
+                    yield token, count, current - since[token]
+                counts[token] = count + delta
+                since[token] = current
+
+        if len(window) < self._parts_size:
+            return
+        for token, count in counts.items():
+            if count > 0:
+                yield token, count, current + 1 - since[token]
 
     def parts_size(self):
         return self._parts_size
@@ -0,0 +1,103 @@
+import numpy
+import book_classification as bc
+
+
+# MinHash signatures of the sets of token shingles of books: the fraction of
+# positions where two signatures agree estimates the Jaccard similarity of the
+# sets; tokens go through stable_hash, so signatures are the same in every run
+class MinHasher:
+    _prime = numpy.uint64(1099511628211)
+
+    def __init__(self, tokenizer, shingle_size=5, num_permutations=128, seed=0):
+        self._tokenizer = tokenizer
+        self._shingle_size = shingle_size
+        self._num_permutations = num_permutations
+        # multiply-shift hashing, with odd multipliers
+        generator = numpy.random.RandomState(seed)
+        self._multipliers = generator.randint(0, 2**63, num_permutations, dtype=numpy.uint64) * 2 + 1
+        self._increments = generator.randint(0, 2**63, num_permutations, dtype=numpy.uint64)
+
+    def num_permutations(self):
+        return self._num_permutations
+
+    def shingles_from(self, book):
+        hashes = bc.token_hashes(self._tokenizer.tokens_from(book), bc.interner_of(self._tokenizer))
+
+        # polynomial hash of every window of shingle_size tokens, wrapping around 2**64
+        k = min(self._shingle_size, len(hashes))
+        if k == 0:
+            return numpy.zeros(0, dtype=numpy.uint64)
+        shingles = numpy.zeros(len(hashes) - k + 1, dtype=numpy.uint64)
+        for j in range(k):
+            shingles = shingles * self._prime + hashes[j:len(hashes) - k + 1 + j]
+        return numpy.unique(shingles)
+
+    def signature_for(self, book, block_size=16):
+        shingles = self.shingles_from(book)
+        signature = numpy.full(self._num_permutations, numpy.iinfo(numpy.uint64).max, dtype=numpy.uint64)
+        if len(shingles) == 0:
+            return signature
+        # a few permutations at a time, to keep the temporary matrix small
+        for start in range(0, self._num_permutations, block_size):
+            a = self._multipliers[start:start+block_size, None]
+            b = self._increments[start:start+block_size, None]
+            values = (a * shingles[None, :] + b) >> numpy.uint64(32)
+            signature[start:start+block_size] = values.min(axis=1)
+        return signature
+
+    def fingerprint_state(self):
+        return (bc.fingerprint(self._tokenizer), self._shingle_size, self._num_permutations,
+            self._multipliers.tobytes(), self._increments.tobytes())
+
+
+# locality sensitive hashing: signatures are cut in bands, and books sharing
+# all the rows of any band land in the same bucket; only those pairs are
+# compared, so the work grows with the number of candidates, not its square
+class LshIndex:
+    def __init__(self, num_permutations, threshold):
+        self._threshold = threshold
+        self._bands = self.bands_for(num_permutations, threshold)
+        self._rows = num_permutations // self._bands
+        self._buckets = {}
+        self._signatures = []
+
+    @staticmethod
+    def bands_for(num_permutations, threshold):
+        # pairs are likely to become candidates above (1/bands)**(1/rows)
+        divisors = [b for b in range(1, num_permutations + 1) if num_permutations % b == 0]
+        return min(divisors, key=lambda b: abs((1 / b) ** (b / num_permutations) - threshold))
+
+    def add(self, signature):
+        key = len(self._signatures)
+        self._signatures.append(signature)
+        # books without any shingle are not near anything
+        if signature.min() == numpy.iinfo(numpy.uint64).max:
+            return key
+        for band in range(self._bands):
+            rows = signature[band*self._rows:(band+1)*self._rows].tobytes()
+            self._buckets.setdefault((band, rows), []).append(key)
+        return key
+
+    def similarity(self, i, j):
+        return numpy.mean(self._signatures[i] == self._signatures[j])
+
+    def clusters(self):
+        # lists of keys, in the order they were added, with more than one key each
+        parents = list(range(len(self._signatures)))
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for bucket in self._buckets.values():
+            for n, i in enumerate(bucket):
+                for j in bucket[:n]:
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j and self.similarity(i, j) >= self._threshold:
+                        parents[max(root_i, root_j)] = min(root_i, root_j)
+
+        groups = {}
+        for key in range(len(self._signatures)):
+            groups.setdefault(find(key), []).append(key)
+        return [group for group in groups.values() if len(group) > 1]
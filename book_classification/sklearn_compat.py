@@ -23,6 +23,9 @@ class SklExtractor:
         collection = bc.BookCollection.from_books(books_list)
         return self._matrix_extractor.extract_from(collection)
 
+    def fit_transform(self, books_list, y=None):
+        return self.fit(books_list, y)._matrix_extractor.training_matrix()
+
 
 class SklModelAdapter:
     def __init__(self, model):
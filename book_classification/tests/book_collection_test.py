@@ -1,6 +1,11 @@
 import book_classification as bc
 import os
 from nose.tools import *
+import tempfile
+import shutil
+import pickle
+import time
+import numpy
 
 my_book_one = bc.Book.from_str("Title: Book One\nAuthor: A\nthe text")
 my_book_two = bc.Book.from_str("Title: Book Two\nAuthor: A\nthe text")
@@ -43,4 +48,142 @@ def test_ShouldPartitionByAuthorAndQuantity():
 
 	eq_(len(anotherBookCollectionTwo.books_by("A")), 1)
 	ok_("B" not in anotherBookCollectionTwo.authors())
-	ok_("C" not in anotherBookCollectionTwo.authors())
\ No newline at end of file
+	ok_("C" not in anotherBookCollectionTwo.authors())
+
+def test_CanOpenACollectionFromACorpusStore():
+	path = tempfile.mkdtemp()
+	try:
+		books = [my_book_one, my_book_four, bc.Book("\u00c9mile", "\u00c9t\u00e9", "caf\u00e9 \u00e0 la cr\u00e8me")]
+		bc.BookCollection.from_books(books).to_corpus_store(path)
+		stored = bc.BookCollection.from_corpus_store(path)
+
+		eq_(len(stored), 3)
+		for original, book in zip(books, stored.books()):
+			eq_(book.author(), original.author())
+			eq_(book.title(), original.title())
+			eq_(book.contents(), original.contents())
+			eq_(book.content_hash(), original.content_hash())
+			eq_(bytes(book.view()), original.contents().encode("utf-8"))
+		eq_(stored.books_by("B"), {stored.books()[1]})
+		eq_(pickle.loads(pickle.dumps(stored.books()[2])).contents(), books[2].contents())
+	finally:
+		shutil.rmtree(path)
+
+def test_CorpusStoreClosesWithViewsAlive():
+	path = tempfile.mkdtemp()
+	try:
+		with bc.BookCollection.from_books([my_book_one, my_book_four]).to_corpus_store(path) as store:
+			view = store.book(1).view()
+		eq_(bytes(view), my_book_four.contents().encode("utf-8"))
+
+		one, four = [pickle.loads(pickle.dumps(book)) for book in store.books()]
+		ok_(one._store is four._store)
+		eq_(four.contents(), my_book_four.contents())
+	finally:
+		shutil.rmtree(path)
+
+def test_LoaderReportsFailuresInsteadOfStopping():
+	directory = os.path.dirname(__file__)
+	paths = [os.path.join(directory, name) for name in
+		["pg1465.txt", "pg1465_noauthor.txt", "pg1465.txt.gz", "pg1465.zip"]]
+	for loader in [bc.BookLoader(processes=1), bc.BookLoader(processes=2, threads=True),
+			bc.BookLoader(processes=2, max_in_flight=1, lazy=True)]:
+		collection = bc.BookCollection.from_file_path_list(paths, loader)
+		eq_([book.source() for book in collection.books()], [paths[0], paths[2], paths[3]])
+		eq_(len(set(book.contents() for book in collection.books())), 1)
+		eq_([path for path, _ in loader.failures()], [paths[1]])
+		eq_(loader.stats()['books'], 3)
+		ok_(loader.stats()['megabytes_per_second'] > 0)
+
+def test_LoaderDoesNotCountTheTimeOfTheCaller():
+	path = os.path.join(os.path.dirname(__file__), "pg1465.txt")
+	loader = bc.BookLoader(processes=1, lazy=True)
+	for book in loader.load([path, path]):
+		time.sleep(0.2)
+	eq_(loader.stats()['books'], 2)
+	ok_(loader.stats()['seconds'] < 0.2)
+
+@raises(Exception)
+def test_LoadingWithoutALoaderStopsAtTheFirstFailure():
+	directory = os.path.dirname(__file__)
+	bc.BookCollection.from_file_path_list([os.path.join(directory, "pg1465_noauthor.txt")])
+
+def test_SelectionsAreViewsInCollectionOrder():
+	books = [my_book_one, my_book_four, my_book_two, my_book_six, my_book_three, my_book_five]
+	aBookCollection = bc.BookCollection.from_books(books)
+	selection = aBookCollection.selection()
+
+	view = selection.filter_authors(lambda author: author != "B")
+	ok_(isinstance(view, bc.BookCollectionView))
+	eq_(view.books(), [my_book_one, my_book_two, my_book_six, my_book_three])
+	eq_(view.books_by("A"), {my_book_one, my_book_two, my_book_three})
+	eq_(list(view.author_rows()["A"]), [0, 1, 3])
+
+	with bc.RandomContext(7):
+		sampled = selection.sample_books_per_author(1)
+	eq_(len(sampled), 3)
+	eq_(set(sampled.authors()), {"A", "B", "C"})
+	eq_(sampled.books(), [book for book in books if book in sampled.books()])
+
+	one, two = selection.partition_books(lambda book: book.author() == "C")
+	eq_(one.books(), [my_book_six])
+	eq_(len(two), 5)
+
+def test_ChainedViewsPointAtTheFirstCollection():
+	books = [my_book_one, my_book_four, my_book_two, my_book_six, my_book_three, my_book_five]
+	aBookCollection = bc.BookCollection.from_books(books)
+	first = aBookCollection.selection().filter_authors(lambda author: author != "C")
+	second = first.selection().filter_books(lambda book: book is not my_book_two)
+
+	ok_(second.collection() is aBookCollection)
+	eq_(list(second.rows()), [0, 1, 4, 5])
+	eq_(list(second.authors()), ["A", "B"])
+	eq_(second.books_by("B"), {my_book_four, my_book_five})
+
+def test_DuplicatesAreFoundByTitleWithoutLoadingContents():
+	copy = bc.Book("Someone else", my_book_two.title(), None)
+	aBookCollection = bc.BookCollection.from_books([my_book_one, my_book_two, copy, my_book_four])
+	eq_(aBookCollection.selection().remove_duplicates().books(), [my_book_one, my_book_two, my_book_four])
+	eq_(aBookCollection.selection().find_duplicates().books(), [copy])
+
+def test_CollectionsFromSetsHaveAStableOrder():
+	aBookCollection = bc.BookCollection.from_books(my_books_all)
+	eq_([book.title() for book in aBookCollection.books()],
+		["Book One", "Book Three", "Book Two", "Book Five", "Book Four", "Book Six"])
+
+def test_NearDuplicatesAreFoundAcrossTitles():
+	path = os.path.join(os.path.dirname(__file__), "pg1465.txt")
+	text = open(path).read()
+	original = bc.Book("Charles Dickens", "The Wreck of the Golden Mary", text)
+	release = bc.Book("Charles Dickens", "The Wreck Of The Golden Mary (2nd release)",
+		"Produced by someone else.\n" + text[:len(text) - 2000])
+	other = bc.Book("Someone", "Animals", "A book about how animals survive in extreme environments.")
+	aBookCollection = bc.BookCollection.from_books([original, other, release])
+
+	eq_(aBookCollection.selection().find_near_duplicates(), [[original, release]])
+	eq_(aBookCollection.selection().remove_near_duplicates(0.9).books(), [original, other])
+	eq_(aBookCollection.selection().find_near_duplicates(0.999), [])
+
+def test_MinHashSignaturesEstimateJaccard():
+	hasher = bc.MinHasher(bc.DummySequenceTokenizer(), shingle_size=1, num_permutations=256)
+	one = hasher.signature_for([str(i) for i in range(0, 300)])
+	two = hasher.signature_for([str(i) for i in range(100, 400)])
+	ok_(abs(numpy.mean(one == two) - 0.5) < 0.1)
+
+def test_AnalysisCountsSharedWords():
+	books = [bc.Book("A", "One", "red green blue"), bc.Book("A", "Two", "red red yellow"),
+		bc.Book("B", "Three", "red green")]
+	analysis = bc.BookCollectionAnalysis(bc.BookCollection.from_books(books), bc.BasicTokenizer())
+
+	eq_(dict(analysis.shared_words_by_books()), {1: 2, 2: 1, 3: 1})
+	eq_(dict(analysis.shared_words_by_authors()), {1: 2, 2: 2})
+	eq_(list(analysis.vocabulary_size_by_book()["Unique words"]), [3, 2, 2])
+	eq_(list(analysis.vocabulary_size_by_book()["Book"]), books)
+	eq_(dict(analysis.vocabulary_size_by_author().values.tolist()), {"A": 4, "B": 2})
+	eq_(len(analysis.vocabulary().by_author("A")), 4)
+	eq_(analysis.vocabulary_size(), len(analysis.vocabulary().total()))
+
+	interner = bc.TokenInterner(["black", "white"])
+	interned = bc.BookCollectionAnalysis(bc.BookCollection.from_books(books),
+		bc.InterningTokenizer(bc.BasicTokenizer(), interner))
+	eq_(interned.vocabulary_size(), 4)
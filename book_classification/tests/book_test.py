@@ -6,7 +6,7 @@ path_to_books = os.path.dirname(__file__)
 
 def equals_mybook(aBook):
 	aBookPath = os.path.join(path_to_books, "pg1465.txt")
-	contents = open(aBookPath, "rU").read()
+	contents = open(aBookPath, "r").read()
 
 	eq_(aBook.author(), "Charles Dickens")
 	eq_(aBook.title(), "The Wreck of the Golden Mary")
@@ -35,4 +35,22 @@ def test_ShouldCreateABookFromZip():
 def test_BookFromFileShouldHavePath():
 	aBookPath = os.path.join(path_to_books, "pg1465.txt")
 	aBook = book.Book.from_file_path(aBookPath)
-	eq_(aBook.source(), aBookPath)
\ No newline at end of file
+	eq_(aBook.source(), aBookPath)
+
+def test_LazyBooksReadOnlyTheHeader():
+	for name in ["pg1465.txt", "pg1465.txt.gz", "pg1465.zip"]:
+		aBook = book.Book.from_file_path(os.path.join(path_to_books, name), lazy=True)
+		eq_(aBook._contents, None)
+		equals_mybook(aBook)
+
+@raises(Exception)
+def test_LazyBooksShouldFailIfAuthorIsMissing():
+	aBookPath = os.path.join(path_to_books, "pg1465_noauthor.txt")
+	book.Book.from_file_path(aBookPath, lazy=True)
+
+def test_LazyBooksAreHashedWithoutKeepingTheirContents():
+	for name in ["pg1465.txt", "pg1465.txt.gz", "pg1465.zip"]:
+		path = os.path.join(path_to_books, name)
+		aBook = book.Book.from_file_path(path, lazy=True)
+		eq_(aBook.content_hash(), book.Book.from_file_path(path).content_hash())
+		eq_(aBook._contents, None)
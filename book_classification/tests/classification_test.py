@@ -2,6 +2,9 @@ import book_classification as bc
 from nose.tools import *
 from sklearn import svm
 from sklearn import decomposition
+import tempfile
+import shutil
+import os
 from book_classification.tests.books import *
 
 
@@ -17,3 +20,48 @@ def test_ClassificationModel():
 
 def test_ClassificationResults():
     pass
+
+
+def test_PrecomputedClassificationModel():
+    tokenizer = bc.BasicTokenizer()
+    extractor = bc.FrequenciesExtractor(tokenizer)
+    classification_model = bc.PrecomputedClassificationModel.for_collection(
+        extractor, bigCollection, decomposition.TruncatedSVD(10), svm.SVC())
+    classification_model.fit(trainingCollection)
+    classification_results = classification_model.predict(testingCollection)
+    eq_(classification_results._expected, classification_results._predicted)
+
+
+def run_training_proportion(scheduler):
+    extractor = bc.FrequenciesExtractor(bc.BasicTokenizer())
+    model = bc.PrecomputedClassificationModel.for_collection(
+        extractor, bigCollection, decomposition.TruncatedSVD(2), svm.SVC())
+    experiment = bc.ESOverTrainingProportion(bigCollection, model, scheduler)
+    config = {'num_books': 3, 'num_authors': 2, 'num_steps': 3, 'num_trials': 3}
+    return experiment.run_experiment(config)
+
+
+def test_TrialSchedulerResultsDontDependOnProcesses():
+    serial = run_training_proportion(bc.TrialScheduler(master_seed=42))
+    parallel = run_training_proportion(bc.TrialScheduler(processes=2, master_seed=42))
+    eq_(len(serial), 2)
+    eq_([len(trials) for trials in serial], [3, 3])
+    eq_(serial, parallel)
+
+
+def test_TrialSchedulerResumesFromCheckpoint():
+    directory = tempfile.mkdtemp()
+    try:
+        checkpoint = os.path.join(directory, 'checkpoint.json')
+        expected = run_training_proportion(bc.TrialScheduler(master_seed=42, checkpoint=checkpoint))
+
+        class FailingModel:
+            def fit(self, collection):
+                raise AssertionError("trial should come from the checkpoint")
+
+        experiment = bc.ESOverTrainingProportion(bigCollection, FailingModel(),
+            bc.TrialScheduler(master_seed=42, checkpoint=checkpoint))
+        config = {'num_books': 3, 'num_authors': 2, 'num_steps': 3, 'num_trials': 3}
+        eq_(experiment.run_experiment(config), expected)
+    finally:
+        shutil.rmtree(directory)
@@ -1,5 +1,9 @@
 import book_classification as bc
 from nose.tools import *
+from scipy import sparse
+import tempfile
+import shutil
+import os
 from book_classification.tests.books import *
 
 
@@ -52,3 +56,186 @@ def test_CollectionFeaturesMatrixExtractor():
     eq_(matrixTwo.shape, (2, 11))
     eq_(matrixTwo.nnz, 7)
     ok_(abs(matrixTwo.sum() - 0.633333333333) < 10**-10)
+
+
+def test_SparseRowsBuilderMatchesDokMatrix():
+    rows = [([2, 0], [0.5, 1.5]), ([], []), ([1, 3, 2], [4.0, 0.0, 2.5])]
+    builder = bc.SparseRowsBuilder(3, 4, 2)
+    expected = sparse.dok_matrix((3, 4))
+    for i, (indices, values) in enumerate(rows):
+        builder.append_row(indices, values)
+        for j, v in zip(indices, values):
+            expected[i, j] = v
+
+    matrix = builder.tocsr()
+    expected = expected.tocsr()
+    eq_(matrix.shape, expected.shape)
+    eq_(matrix.nnz, expected.nnz)
+    eq_(list(matrix.indptr), list(expected.indptr))
+    eq_(matrix.toarray().tolist(), expected.toarray().tolist())
+
+
+def test_FeaturesEncoderRemapsTokenIds():
+    interner = bc.TokenInterner()
+    tokenizer = bc.InterningTokenizer(bc.BasicTokenizer(), interner)
+    extractor = bc.FrequenciesExtractor(tokenizer)
+    matrix = bc.CollectionFeaturesMatrixExtractor(
+        extractor, trainingCollection).extract_from(testingCollection)
+
+    expected = bc.CollectionFeaturesMatrixExtractor(
+        bc.FrequenciesExtractor(bc.BasicTokenizer()), trainingCollection).extract_from(testingCollection)
+    eq_(matrix.shape, expected.shape)
+    eq_(matrix.nnz, expected.nnz)
+    ok_(abs(matrix.sum() - expected.sum()) < 10**-10)
+
+
+def test_FeaturesEncoderHandlesAnyIntegerKeys():
+    for vocabulary in [[3, 2**31 - 5], [-1, 0, 5]]:
+        encoder = bc.FeaturesEncoder(vocabulary)
+        features = bc.TokenFrequencies(None, dict((k, 1.0) for k in vocabulary + [7]), 3)
+        indices, values = encoder.encode_arrays(features)
+        eq_(sorted(indices.tolist()), sorted(j for j, _ in encoder.encode(features)))
+        eq_(len(indices), len(vocabulary))
+
+
+def test_CollectionFeaturesExtractorAcceptsMultiExtractor():
+    tokenizer = bc.BasicTokenizer()
+    frequencies = bc.FrequenciesExtractor(tokenizer)
+    extractor = bc.MultiExtractor(tokenizer).register(
+        'frequencies', frequencies).register('vocabularies', bc.VocabulariesExtractor(tokenizer))
+    collection_features = bc.CollectionFeaturesExtractor(extractor).extract_from(trainingCollection)
+
+    frequencies_features = collection_features.component('frequencies')
+    for book in trainingCollection.books():
+        eq_(frequencies_features.by_book(book), frequencies.extract_from(book))
+
+
+def test_ParallelCollectionFeaturesExtractorMatchesSerial():
+    extractor = bc.FrequenciesExtractor(bc.BasicTokenizer())
+    expected = bc.SerialCollectionFeaturesExtractor(extractor).extract_from(bigCollection)
+
+    with bc.ParallelCollectionFeaturesExtractor(extractor, processes=2, chunksize=2) as parallel:
+        for _ in range(2):
+            features = parallel.extract_from(bigCollection)
+            for book in bigCollection.books():
+                eq_(features.by_book(book), expected.by_book(book))
+
+
+def test_ParallelCollectionFeaturesExtractorTranslatesTokenIds():
+    interner = bc.TokenInterner()
+    extractor = bc.SeriesExtractor(bc.InterningTokenizer(bc.BasicTokenizer(), interner))
+    expected = bc.SeriesExtractor(bc.BasicTokenizer())
+
+    with bc.ParallelCollectionFeaturesExtractor(extractor, processes=2) as parallel:
+        features = parallel.extract_from(bigCollection)
+    for book in bigCollection.books():
+        decoded = dict(interner.decode_items(features.by_book(book).items()))
+        eq_(decoded, dict(expected.extract_from(book).items()))
+
+
+class CountingExtractor:
+    def __init__(self, extractor):
+        self._extractor = extractor
+        self.calls = 0
+
+    def extract_from(self, book):
+        self.calls += 1
+        return self._extractor.extract_from(book)
+
+
+def test_CollectionFeaturesMatrixExtractorExtractsTrainingOnce():
+    extractor = CountingExtractor(bc.FrequenciesExtractor(bc.BasicTokenizer()))
+    matrix_extractor = bc.CollectionFeaturesMatrixExtractor(extractor, trainingCollection)
+    eq_(extractor.calls, len(trainingCollection))
+
+    matrix = matrix_extractor.extract_from(trainingCollection)
+    eq_(extractor.calls, len(trainingCollection))
+    eq_(matrix.shape, (2, 11))
+
+    encoder, expected = bc.CollectionFeaturesExtractor(extractor).encoder_and_matrix_for(trainingCollection)
+    eq_((matrix != expected).nnz, 0)
+    eq_(encoder.vocabulary(), matrix_extractor.encoder().vocabulary())
+
+
+def test_PrecomputedCollectionFeaturesSliceLikeExtraction():
+    tokenizer = bc.BasicTokenizer()
+    for extractor in [bc.FrequenciesExtractor(tokenizer), bc.EntropiesExtractor(tokenizer, bc.FixedGrouper(3))]:
+        precomputed = bc.PrecomputedCollectionFeatures(extractor, bigCollection)
+        matrix_extractor = precomputed.matrix_extractor_for(trainingCollection)
+        expected_extractor = bc.CollectionFeaturesMatrixExtractor(extractor, trainingCollection)
+
+        eq_(matrix_extractor.vocabulary(), expected_extractor.encoder().vocabulary())
+        for collection in [trainingCollection, testingCollection]:
+            matrix = matrix_extractor.extract_from(collection)
+            expected = expected_extractor.extract_from(collection)
+            eq_(matrix.shape, expected.shape)
+            eq_(matrix.toarray().tolist(), expected.toarray().tolist())
+
+
+def test_CollectionHierarchialFeaturesCanCombineAuthorsInParallel():
+    extractor = bc.VocabulariesExtractor(bc.BasicTokenizer())
+    expected = bc.CollectionHierarchialFeatures.from_book_collection(bigCollection, extractor)
+    result = bc.CollectionHierarchialFeatures.from_book_collection(bigCollection, extractor, processes=2)
+
+    for author in bigCollection.authors():
+        eq_(result.by_author(author), expected.by_author(author))
+    eq_(result.total(), expected.total())
+
+
+def test_HashingExtractorNeedsNoVocabulary():
+    extractor = bc.HashingExtractor(bc.BasicTokenizer(), ngram_range=(1, 3), num_bits=12)
+    matrix_extractor = bc.CollectionFeaturesMatrixExtractor(extractor, trainingCollection)
+    eq_(matrix_extractor.encoder(), None)
+
+    training = matrix_extractor.training_matrix()
+    testing = matrix_extractor.extract_from(testingCollection).tocsr()
+    eq_(training.shape, (2, 2**12))
+    eq_(testing.shape, (2, 2**12))
+    for row, book in enumerate(testingCollection.books()):
+        features = extractor.extract_from(book)
+        eq_(dict(zip(testing[row].indices, testing[row].data)), dict(features.items()))
+
+    transformer = bc.SklExtractor(extractor)
+    eq_((transformer.fit_transform(trainingCollection.books()) != training).nnz, 0)
+
+
+def test_HashedColumnsDoNotDependOnTheInterner():
+    extractor = bc.HashingExtractor(bc.InterningTokenizer(bc.BasicTokenizer()), ngram_range=(1, 2), num_bits=12)
+    expected = bc.HashingExtractor(bc.BasicTokenizer(), ngram_range=(1, 2), num_bits=12)
+    multi = bc.MultiExtractor(extractor._tokenizer).register('hashing', extractor)
+
+    with bc.ParallelCollectionFeaturesExtractor(multi, processes=2) as parallel:
+        features = parallel.extract_from(bigCollection)
+    for book in bigCollection.books():
+        eq_(features.component('hashing').by_book(book), expected.extract_from(book))
+
+
+def test_ParallelExtractorSendsBooksWhoseFileChanged():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "book.txt")
+        with open(path, "w") as f:
+            f.write("Title: One\nAuthor: Someone\nthe original text")
+        book = bc.Book.from_file_path(path)
+        with open(path, "w") as f:
+            f.write("Title: One\nAuthor: Someone\nsomething else entirely")
+
+        extractor = bc.FrequenciesExtractor(bc.BasicTokenizer())
+        collection = bc.BookCollection.from_books([book])
+        with bc.ParallelCollectionFeaturesExtractor(extractor, processes=2) as parallel:
+            features = parallel.extract_from(collection)
+        eq_(features.by_book(book), extractor.extract_from(book))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_ParallelExtractorLeavesHashingLazyBooksToWorkers():
+    path = os.path.join(os.path.dirname(__file__), "pg1465.txt.gz")
+    book = bc.Book.from_file_path(path, lazy=True)
+    extractor = bc.VocabulariesExtractor(bc.BasicTokenizer())
+    with bc.ParallelCollectionFeaturesExtractor(extractor, processes=2) as parallel:
+        features = parallel.extract_from(bc.BookCollection.from_books([book]))
+
+    ok_(book.is_lazy())
+    eq_(book.cached_content_hash(), bc.Book.from_file_path(path).content_hash())
+    eq_(features.by_book(book), extractor.extract_from(bc.Book.from_file_path(path)))
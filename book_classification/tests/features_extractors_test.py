@@ -76,3 +76,139 @@ def test_CanExtractPairwiseAssociation():
     eq_(len(assocs), 9)
     eq_(assocs.total_counts(), 40)
     eq_(dict(assocs.items()), expected)
+
+
+def test_ExtractorsGiveSameFeaturesFromTokenIds():
+    sequence = ["one", "two", "one", "three", "three", "two", "three"]
+    interner = bc.TokenInterner()
+    tokenizer = bc.InterningTokenizer(bc.DummySequenceTokenizer(), interner)
+
+    for builder in [bc.VocabulariesExtractor, bc.FrequenciesExtractor, bc.SeriesExtractor]:
+        expected = builder(bc.DummySequenceTokenizer()).extract_from(sequence)
+        features = builder(tokenizer).extract_from(sequence)
+        eq_(features.total_counts(), expected.total_counts())
+        eq_(dict(interner.decode_items(features.items())), dict(expected.items()))
+
+
+def test_SlidingEntropiesMatchEntropiesOverEveryWindow():
+    sequence = ["one", "two", "one", "three", "three", "two", "three", "one", "one"]
+    grouper = bc.SlidingGrouper(4)
+    extractor = bc.EntropiesExtractor(bc.DummySequenceTokenizer(), grouper)
+    windows = list(grouper.parts_from(sequence))
+    expected = bc.EntropiesExtractor(
+        bc.DummySequenceTokenizer(), bc.DummyGrouper()).extract_from(windows)
+
+    entropies = extractor.extract_from(sequence)
+    eq_(entropies.total_counts(), expected.total_counts())
+    eq_(set(entropies.keys()), set(expected.keys()))
+    for key in expected.keys():
+        ok_(abs(entropies[key] - expected[key]) < 10**-10)
+
+
+def test_FixedEntropiesFromTokenIdsMatchGenericExtraction():
+    sequence = ["one", "two", "one", "three", "three", "two", "three", "one", "one"]
+    interner = bc.TokenInterner()
+    grouper = bc.FixedGrouper(4)
+    expected = bc.EntropiesExtractor(bc.DummySequenceTokenizer(), grouper).extract_from(sequence)
+    entropies = bc.EntropiesExtractor(
+        bc.InterningTokenizer(bc.DummySequenceTokenizer(), interner), grouper).extract_from(sequence)
+
+    eq_(entropies.total_counts(), expected.total_counts())
+    eq_(dict(interner.decode_items(entropies.items())), dict(expected.items()))
+
+
+class CountingTokenizer(bc.Tokenizer):
+    def __init__(self):
+        self.calls = 0
+
+    def tokens_from(self, sequence):
+        self.calls += 1
+        return iter(sequence)
+
+
+def test_MultiExtractorTokenizesOnce():
+    sequence = ["one", "two", "one", "three", "three", "two", "three"]
+    tokenizer = CountingTokenizer()
+    extractors = {
+        'vocabularies': bc.VocabulariesExtractor(tokenizer),
+        'frequencies': bc.FrequenciesExtractor(tokenizer),
+        'series': bc.SeriesExtractor(tokenizer),
+        'entropies': bc.EntropiesExtractor(tokenizer, bc.FixedGrouper(3))}
+    extractor = bc.MultiExtractor(tokenizer, extractors)
+
+    features = extractor.extract_from(sequence)
+    eq_(tokenizer.calls, 1)
+    eq_(set(features.names()), set(extractors.keys()))
+    for name, single_extractor in extractors.items():
+        eq_(features[name], single_extractor.extract_from(sequence))
+
+
+def test_CachedExtractorWrapperEvictsLeastRecentlyUsed():
+    extractor = bc.CachedExtractorWrapper(
+        bc.FrequenciesExtractor(bc.BasicTokenizer()), max_entries=2)
+    books = [bc.Book("A", "One", "one two"), bc.Book("A", "Two", "two three"),
+        bc.Book("A", "Three", "three four")]
+
+    extractor.extract_from(books[0])
+    extractor.extract_from(books[1])
+    extractor.extract_from(books[0])
+    extractor.extract_from(books[2])
+    extractor.extract_from(bc.Book("B", "Copy", "one two"))
+    eq_(extractor.stats()['hits'], 2)
+    eq_(extractor.stats()['evictions'], 1)
+    eq_(extractor.stats()['entries'], 2)
+
+    extractor.extract_from(books[1])
+    eq_(extractor.stats()['misses'], 4)
+
+
+def test_CachedExtractorWrapperEvictsLeastFrequentlyUsedBySize():
+    extractor = bc.CachedExtractorWrapper(
+        bc.SeriesExtractor(bc.BasicTokenizer()), max_bytes=1, policy='lfu')
+    extractor.extract_from(bc.Book("A", "One", "one two"))
+    extractor.extract_from(bc.Book("A", "Two", "two three"))
+
+    stats = extractor.stats()
+    eq_(stats['entries'], 1)
+    eq_(stats['evictions'], 1)
+    ok_(stats['bytes'] > 0)
+
+
+def test_HashingExtractorCountsNgramsInFixedColumns():
+    tokenizer = bc.DummySequenceTokenizer()
+    extractor = bc.HashingExtractor(tokenizer, ngram_range=(1, 2), num_bits=20, signed=False)
+    features = extractor.extract_from(["a", "b", "a", "b"])
+
+    # a, b, ab twice and ba once, over 4 tokens
+    eq_(sorted(features.values()), [0.25, 0.5, 0.5, 0.5])
+    eq_(features.total_counts(), 4)
+    ok_(all(0 <= key < 2**20 for key in features.keys()))
+
+    columns, values = extractor.row_from(["b", "a", "c"])
+    unigrams = bc.HashingExtractor(tokenizer, num_bits=20, signed=False).extract_from(["a", "b"])
+    ok_(set(unigrams.keys()) <= set(columns.tolist()))
+
+    signed = bc.HashingExtractor(tokenizer, ngram_range=(1, 2), num_bits=20).extract_from(["a", "b", "a", "b"])
+    eq_(sorted(abs(value) for value in signed.values()), [0.25, 0.5, 0.5, 0.5])
+
+
+@raises(ValueError)
+def test_MultiExtractorRejectsExtractorsWithAnotherTokenizer():
+    tokenizer = bc.BasicTokenizer()
+    filtering = bc.FilteringTokenizer(tokenizer, ['book'])
+    bc.MultiExtractor(tokenizer).register('frequencies', bc.FrequenciesExtractor(filtering))
+
+
+def test_ExtractorsTellWhichArraysHoldTokens():
+    interner = bc.TokenInterner()
+    tokenizer = bc.InterningTokenizer(bc.DummySequenceTokenizer(), interner)
+    extractor = bc.MultiExtractor(tokenizer, {
+        'frequencies': bc.FrequenciesExtractor(tokenizer),
+        'hashed': bc.HashingExtractor(tokenizer)})
+    wrapper = bc.CachedExtractorWrapper(extractor)
+
+    ok_(wrapper.interner() is interner)
+    eq_(wrapper.token_key_arrays(), ['frequencies/keys'])
+    features = bc.features_to_arrays(wrapper.extract_from(("a", "b", "a")))
+    ok_(set(wrapper.token_key_arrays()) < set(features))
+    eq_(bc.FrequenciesExtractor(bc.DummySequenceTokenizer()).interner(), None)
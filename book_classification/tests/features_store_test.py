@@ -0,0 +1,99 @@
+import book_classification as bc
+from nose.tools import *
+from book_classification.tests.books import *
+import tempfile
+import shutil
+import numpy
+
+
+def with_store(test):
+    def wrapper():
+        path = tempfile.mkdtemp()
+        try:
+            test(path)
+        finally:
+            shutil.rmtree(path)
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+
+@with_store
+def test_PersistentExtractorRoundTripsAllFeatures(path):
+    tokenizer = bc.BasicTokenizer()
+    extractors = [
+        bc.VocabulariesExtractor(tokenizer),
+        bc.FrequenciesExtractor(tokenizer),
+        bc.SeriesExtractor(tokenizer),
+        bc.EntropiesExtractor(tokenizer, bc.FixedGrouper(3)),
+        bc.MultiExtractor(tokenizer).register('frequencies', bc.FrequenciesExtractor(tokenizer))]
+
+    for extractor in extractors:
+        expected = extractor.extract_from(book_4)
+        with bc.PersistentExtractorWrapper(extractor, path) as wrapper:
+            eq_(wrapper.extract_from(book_4), expected)
+        with bc.PersistentExtractorWrapper(extractor, path) as wrapper:
+            eq_(wrapper.extract_from(book_4), expected)
+            eq_(wrapper.stats()['hits'], 1)
+
+
+@with_store
+def test_PersistentExtractorKeysOnContentsAndConfiguration(path):
+    tokenizer = bc.BasicTokenizer()
+    same_title = bc.Book(book_1.author(), book_1.title(), book_3.contents())
+    wrapper = bc.PersistentExtractorWrapper(bc.FrequenciesExtractor(tokenizer), path)
+    wrapper.extract_from(book_1)
+    eq_(wrapper.extract_from(same_title), bc.FrequenciesExtractor(tokenizer).extract_from(book_3))
+    eq_(wrapper.stats()['misses'], 2)
+
+    one = bc.PersistentExtractorWrapper(bc.EntropiesExtractor(tokenizer, bc.FixedGrouper(2)), path)
+    two = bc.PersistentExtractorWrapper(bc.EntropiesExtractor(tokenizer, bc.FixedGrouper(3)), path)
+    one.extract_from(book_1)
+    two.extract_from(book_1)
+    eq_(two.stats()['misses'], 1)
+
+
+@with_store
+def test_FeaturesStoreEvictsLeastRecentlyUsed(path):
+    extractor = bc.SeriesExtractor(bc.BasicTokenizer())
+    store = bc.FeaturesStore(path)
+    for book in bigCollection.books():
+        store.save(extractor, book, extractor.extract_from(book))
+    total = store.size()
+
+    store.evict(total // 2)
+    ok_(store.size() <= total // 2)
+    ok_(store.stats()['evictions'] > 0)
+    store.clear()
+    eq_(store.entries(), [])
+
+
+@with_store
+def test_FeaturesStoreEvictsBelowItsLimit(path):
+    extractor = bc.SeriesExtractor(bc.BasicTokenizer())
+    store = bc.FeaturesStore(path)
+    for book in bigCollection.books():
+        store.save(extractor, book, extractor.extract_from(book))
+    max_size = store.size() - 1
+    store.clear()
+
+    store = bc.FeaturesStore(path, max_size)
+    for book in bigCollection.books():
+        store.save(extractor, book, extractor.extract_from(book))
+    ok_(store.size() <= max_size * store.low_water)
+    ok_(store.stats()['evictions'] > 0)
+
+
+@with_store
+def test_SeriesStoreLoadsMemoryMappedSeries(path):
+    store = bc.SeriesStore(path)
+    extractor = bc.SeriesExtractor(bc.BasicTokenizer())
+    collection = bc.BookCollection.from_books([book_1, book_2, book_4])
+
+    first = dict((book.title(), series) for book, series in store.series_for(extractor, collection))
+    again = dict((book.title(), series) for book, series in store.series_for(extractor, collection))
+
+    for book in collection.books():
+        expected = extractor.extract_from(book)
+        eq_(first[book.title()], expected)
+        eq_(again[book.title()], expected)
+        ok_(isinstance(again[book.title()]._positions, numpy.memmap))
@@ -1,5 +1,6 @@
 import book_classification as bc
 from nose.tools import *
+import numpy
 
 def identicalFeaturesAreEqual(builder):
 	tokenizer = bc.DummySequenceTokenizer()
@@ -74,6 +75,64 @@ def test_CanCombineEntropies():
 	eq_(result.total_counts(), 4)
 	eq_(dict(result.items()), expected)
 
+def test_CanGetManyEntropiesAtOnce():
+	tokenizer = bc.DummySequenceTokenizer()
+	extractor = bc.EntropiesExtractor(tokenizer, bc.DummyGrouper())
+
+	entropies = extractor.extract_from([["one", "two"], ["one", "three"], ["one", "two"], ["one"]])
+	keys = ["one", "two", "three"]
+	result = entropies.values_for(keys)
+	eq_(list(result), [entropies[k] for k in keys])
+
+def combineFromTokenIds(builder):
+	interner = bc.TokenInterner()
+	sequenceOne = ["one", "two", "three", "three", "two"]
+	sequenceTwo = ["one", "three", "four"]
+
+	extractor = builder(bc.DummySequenceTokenizer())
+	expected = extractor.extract_from(sequenceOne).combine(extractor.extract_from(sequenceTwo))
+	extractor = builder(bc.InterningTokenizer(bc.DummySequenceTokenizer(), interner))
+	result = extractor.extract_from(sequenceOne).combine(extractor.extract_from(sequenceTwo))
+
+	ok_(isinstance(result, bc.MixinFeaturesArrays))
+	eq_(result.total_counts(), expected.total_counts())
+	eq_(interner.decode_all(result.keys_array()), sorted(expected.keys(), key=interner.intern))
+	for key, value in interner.decode_items(result.items()):
+		ok_(abs(value - expected[key]) < 10**-10)
+
+def test_CanCombineArrayFeatures():
+	combineFromTokenIds(lambda x: bc.VocabulariesExtractor(x))
+	combineFromTokenIds(lambda x: bc.FrequenciesExtractor(x))
+	combineFromTokenIds(lambda x: bc.EntropiesExtractor(x, bc.FixedGrouper(2)))
+
+def combineAllLikeCombine(builder, interner=None):
+	tokenizer = bc.DummySequenceTokenizer()
+	if interner is not None:
+		tokenizer = bc.InterningTokenizer(tokenizer, interner)
+	extractor = builder(tokenizer)
+	sequences = [["one", "two", "three", "three"], ["one", "three"], ["four", "two", "two", "one", "four"]]
+	features = [extractor.extract_from(x) for x in sequences]
+
+	expected = features[0].combine(features[1]).combine(features[2])
+	result = type(features[0]).combine_all(features)
+	eq_(result.total_counts(), expected.total_counts())
+	eq_(sorted(result.keys()), sorted(expected.keys()))
+	for key in expected.keys():
+		if isinstance(expected[key], list):
+			eq_(result[key], expected[key])
+		else:
+			ok_(abs(result[key] - expected[key]) < 10**-10)
+
+def test_CanCombineAllFeaturesAtOnce():
+	builders = [
+		lambda x: bc.VocabulariesExtractor(x),
+		lambda x: bc.FrequenciesExtractor(x),
+		lambda x: bc.SeriesExtractor(x),
+		lambda x: bc.EntropiesExtractor(x, bc.FixedGrouper(2))]
+	for builder in builders:
+		combineAllLikeCombine(builder)
+		combineAllLikeCombine(builder, bc.TokenInterner())
+
 def test_CanCompareSeries():
 	identicalFeaturesAreEqual(lambda x: bc.SeriesExtractor(x))
 	differentFeaturesAreNotEqual(lambda x: bc.SeriesExtractor(x))
@@ -115,4 +174,19 @@ def test_CanCombinePairwiseAssociation():
 	
 	eq_(len(assocs), 5)
 	eq_(assocs.total_counts(), 30)
-	eq_(dict(assocs.items()), expected)
\ No newline at end of file
+	eq_(dict(assocs.items()), expected)
+
+def test_SeriesArePackedInOneArray():
+	extractor = bc.SeriesExtractor(bc.DummySequenceTokenizer())
+	series = extractor.extract_from(["one", "two", "one", "three", "one"])
+
+	eq_(list(series.positions("one")), [0, 2, 4])
+	ok_(series.positions("one").base is not None)
+	eq_(series.to_arrays()['positions'].dtype, numpy.int32)
+	eq_(list(series.to_arrays()['offsets']), [0, 3, 4, 5])
+
+def test_CanCombineEmptySeries():
+	extractor = bc.SeriesExtractor(bc.DummySequenceTokenizer())
+	result = extractor.extract_from([]).combine(extractor.extract_from(["one", "one"]))
+	eq_(dict(result.items()), {'one': [0, 1]})
+	eq_(result.total_counts(), 2)
@@ -1,4 +1,5 @@
 import book_classification as bc
+import os
 from nose.tools import *
 
 def test_BasicTokenizerShouldProcessASentence():
@@ -17,4 +18,77 @@ def test_CollapsingTokenizerShouldRestrictWords():
 	tokenizer = bc.CollapsingTokenizer(bc.BasicTokenizer(), ['two', 'three'], 'blah')
 	book = bc.DummyBook("one two one two three one two four")
 	result = list(tokenizer.tokens_from(book))
-	eq_(result, ["blah", "two", "blah", "two", "three", "blah", "two", "blah"])
\ No newline at end of file
+	eq_(result, ["blah", "two", "blah", "two", "three", "blah", "two", "blah"])
+
+def test_FastTokenizerShouldProcessASentence():
+	tokenizer = bc.FastTokenizer()
+	book = bc.DummyBook("This, I think; is a n1c3.sentence... with_under score café")
+	result = list(tokenizer.tokens_from(book))
+	eq_(result, ["this", "think", "sentence", "score", "café"])
+	eq_(result, list(bc.BasicTokenizer().tokens_from(book)))
+
+def test_FastTokenizerMatchesBasicTokenizer():
+	aBookPath = os.path.join(os.path.dirname(__file__), "pg1465.txt")
+	book = bc.DummyBook(open(aBookPath).read())
+	expected = list(bc.BasicTokenizer().tokens_from(book))
+	result = list(bc.FastTokenizer().tokens_from(book))
+	eq_(result, expected)
+
+def test_StreamingTokenizerMatchesFastTokenizer():
+	directory = os.path.dirname(__file__)
+	expected = list(bc.FastTokenizer().tokens_from(bc.DummyBook(open(os.path.join(directory, "pg1465.txt")).read())))
+	for name in ["pg1465.txt", "pg1465.txt.gz", "pg1465.zip"]:
+		for chunk_size in [7, 100, 2**16]:
+			book = bc.Book.from_file_path(os.path.join(directory, name), lazy=True)
+			eq_(list(bc.StreamingTokenizer(chunk_size).tokens_from(book)), expected)
+			eq_(book._contents, None)
+
+def test_StreamingTokenizerKeepsWordsCutByChunks():
+	text = "ΟΔΥΣΣΕΥΣ ΚΑΙ ΑΣ'Α words\nsplit_across Chunks ΤΕΛΟΣ"
+	expected = list(bc.FastTokenizer().tokens_from(bc.DummyBook(text)))
+	for chunk_size in range(1, len(text) + 1):
+		eq_(list(bc.StreamingTokenizer(chunk_size).tokens_from(bc.DummyBook(text))), expected)
+		eq_(list(bc.StreamingTokenizer(chunk_size).tokens_from(bc.Book("A", "B", text))), expected)
+
+def test_FilteringAndCollapsingWorkOnTokenIds():
+	interner = bc.TokenInterner(["four"])
+	inner = bc.InterningTokenizer(bc.BasicTokenizer(), interner)
+	book = bc.DummyBook("one two one two three one two four")
+
+	filtering = bc.FilteringTokenizer(inner, ['two', 'three', 'five'])
+	result = filtering.tokens_from(book)
+	eq_(interner.decode_all(result), ["two", "two", "three", "two"])
+
+	collapsing = bc.CollapsingTokenizer(inner, ['two', 'three', 'five'], 'blah')
+	result = collapsing.tokens_from(book)
+	eq_(result.dtype, interner.intern_all([]).dtype)
+	eq_(interner.decode_all(result), ["blah", "two", "blah", "two", "three", "blah", "two", "blah"])
+
+	# words of the vocabulary interned after the first book are found too
+	result = filtering.tokens_from(bc.DummyBook("five two six"))
+	eq_(interner.decode_all(result), ["five", "two"])
+
+def test_StackedTokenizersWorkOnTokenIds():
+	interner = bc.TokenInterner()
+	inner = bc.FilteringTokenizer(bc.InterningTokenizer(bc.BasicTokenizer(), interner), ['one', 'two', 'three'])
+	tokenizer = bc.CollapsingTokenizer(inner, ['two', 'three'], 'blah')
+	book = bc.DummyBook("one two one two three one two four")
+
+	ok_(tokenizer.interner() is interner)
+	eq_(interner.decode_all(tokenizer.tokens_from(book)),
+		["blah", "two", "blah", "two", "three", "blah", "two"])
+	eq_(bc.FilteringTokenizer(bc.BasicTokenizer(), ['one']).interner(), None)
+
+def test_FilteringOnTokenIdsKeepsItsFingerprint():
+	tokenizer = bc.FilteringTokenizer(bc.InterningTokenizer(bc.BasicTokenizer()), ['two', 'three'])
+	extractor = bc.FrequenciesExtractor(tokenizer)
+	before = bc.fingerprint(extractor)
+	extractor.extract_from(bc.DummyBook("one two three"))
+	extractor.extract_from(bc.DummyBook("four five two"))
+	eq_(bc.fingerprint(extractor), before)
+
+def test_FastTokenizerMatchesBasicTokenizerOnUnusualCharacters():
+	for text in ["see note¹ here", "cafe\u0301 na\u0308ive re\u0301sume\u0301 words", "x² plus ½ and Ⅻ roman",
+			"ΟΔΥΣΣΕΥΣ and ß straße", "some​joined word"]:
+		book = bc.DummyBook(text)
+		eq_(list(bc.FastTokenizer().tokens_from(book)), list(bc.BasicTokenizer().tokens_from(book)))
@@ -1,4 +1,7 @@
 import book_classification as bc
+import numpy
+import pickle
+from collections import Counter
 from nose.tools import *
 
 def test_FixedGrouperCanGroupMultiplesOfSize():
@@ -26,6 +29,25 @@ def test_SlidingGrouperWithMoreThanWindowSize():
 	result = grouper.parts_from([0, 1, 2, 3, 4])
 	eq_(list(result), [[0, 1, 2], [1, 2, 3], [2, 3, 4]])
 
+def test_SlidingGrouperReturnsViewsForArrays():
+	grouper = bc.SlidingGrouper(3)
+	array = numpy.arange(5)
+	result = list(grouper.parts_from(array))
+	eq_([list(x) for x in result], [[0, 1, 2], [1, 2, 3], [2, 3, 4]])
+	ok_(all(numpy.shares_memory(x, array) for x in result))
+	eq_(grouper.windows_from(array[:2]).shape, (0, 3))
+
+def test_SlidingGrouperCountSpansMatchWindows():
+	grouper = bc.SlidingGrouper(3)
+	sequence = list("abacbbca")
+	expected = Counter()
+	for window in grouper.parts_from(sequence):
+		expected.update((k, v) for k, v in Counter(window).items())
+	result = Counter()
+	for token, count, windows in grouper.count_spans_from(sequence):
+		result[token, count] += windows
+	eq_(result, expected)
+
 # XXX: weighting window tests
 
 def test_NumericIndexerOnlyRecognizesSomeTokens():
@@ -49,4 +71,40 @@ def test_NumericIndexerShouldEncode():
 def test_NumericIndexerShouldDecode():
 	aNumericIndexer = bc.NumericIndexer("ABC")
 	result = decode_many(aNumericIndexer, [0,0,0,1,1,2])
-	eq_("".join(result), "AAABBC")
\ No newline at end of file
+	eq_("".join(result), "AAABBC")
+
+def test_TokenInternerShouldEncodeAndDecode():
+	interner = bc.TokenInterner()
+	ids = interner.intern_all(["one", "two", "one", "three"])
+	eq_(ids.dtype, numpy.int32)
+	eq_(list(ids), [0, 1, 0, 2])
+	eq_(interner.decode_all(ids), ["one", "two", "one", "three"])
+	eq_(list(interner.lookup_all(["three", "four"])), [2, -1])
+	eq_(len(interner), 3)
+
+def test_TokenInternerCanBePickled():
+	interner = bc.TokenInterner(["one", "two"])
+	copy = pickle.loads(pickle.dumps(interner))
+	eq_(copy.words(), ["one", "two"])
+	eq_(copy.intern("three"), 2)
+
+def test_FingerprintTellsCallablesApart():
+	def adding(n):
+		return lambda token: token + str(n)
+	class Suffix:
+		def __init__(self, n):
+			self._n = n
+		def stem(self, token):
+			return token[:-self._n]
+		def other(self, token):
+			return token[:-self._n]
+
+	fingerprint = lambda transform: bc.fingerprint(bc.TransformingTokenizer(bc.BasicTokenizer(), transform))
+	ok_(fingerprint(adding(3)) != fingerprint(adding(5)))
+	eq_(fingerprint(adding(3)), fingerprint(adding(3)))
+	ok_(len({fingerprint(Suffix(3).stem), fingerprint(Suffix(3).other), fingerprint(Suffix(5).stem)}) == 3)
+	eq_(fingerprint(Suffix(3).stem), fingerprint(Suffix(3).stem))
+
+	from nltk.stem import PorterStemmer, LancasterStemmer
+	ok_(fingerprint(PorterStemmer().stem) != fingerprint(LancasterStemmer().stem))
+	eq_(fingerprint(PorterStemmer().stem), fingerprint(PorterStemmer().stem))
@@ -1,5 +1,8 @@
-from collections import Counter, defaultdict
+from collections import Counter
+from functools import reduce
 import math
+import os
+import numpy
 import book_classification as bc
 
 
@@ -15,12 +18,51 @@ class Features:
     def combine(self, other):
         raise NotImplementedError()
 
+    @classmethod
+    def combine_all(cls, features_list):
+        # subclasses merge everything in one pass, instead of copying the partial result each time
+        features_list = list(features_list)
+        if len(features_list) == 0:
+            raise ValueError("nothing to combine")
+        return reduce(lambda x, y: x.combine(y), features_list)
+
     def __getitem__(self, key):
         raise NotImplementedError()
 
     def total_counts(self):
         raise NotImplementedError()
 
+    def to_arrays(self):
+        # plain numpy arrays by name, for storage without pickle
+        raise NotImplementedError()
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        raise NotImplementedError()
+
+
+# to_arrays along with the name of the features class, so features_from_arrays
+# can bring back any kind of features
+def features_to_arrays(features):
+    arrays = features.to_arrays()
+    arrays['__kind__'] = numpy.array(features.__class__.__name__)
+    return arrays
+
+
+def features_from_arrays(extractor, arrays):
+    arrays = dict(arrays)
+    kind = getattr(bc, str(arrays.pop('__kind__')))
+    return kind.from_arrays(extractor, arrays)
+
+
+def _check_combinable(features_list, same_extractor=True):
+    features_list = list(features_list)
+    if len(features_list) == 0:
+        raise ValueError("nothing to combine")
+    if same_extractor and any(f._extractor != features_list[0]._extractor for f in features_list):
+        raise TypeError("can not combine features from different extractors")
+    return features_list
+
 
 # TODO: throw away this, and provide encodeAs/etc method interacting with an EncodingStrategy
 class MixinFeaturesDict:
@@ -70,6 +112,21 @@ class TokenVocabularies(MixinFeaturesDict, Features):
             data[k] = True
         return self.__class__(self._extractor, data)
 
+    @classmethod
+    def combine_all(cls, features_list):
+        features_list = _check_combinable(features_list)
+        data = {}
+        for features in features_list:
+            data.update(dict.fromkeys(features._entries.keys(), True))
+        return cls(features_list[0]._extractor, data)
+
+    def to_arrays(self):
+        return {'keys': numpy.array(list(self._entries.keys()))}
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        return cls(extractor, dict.fromkeys(arrays['keys'].tolist(), True))
+
 
 class TokenFrequencies(MixinFeaturesDict, Features):
     def __init__(self, extractor, entries, total):
@@ -91,26 +148,165 @@ class TokenFrequencies(MixinFeaturesDict, Features):
 
         return self.__class__(self._extractor, data, total)
 
+    @classmethod
+    def combine_all(cls, features_list):
+        # each one weighted by its total, like combine
+        features_list = _check_combinable(features_list, same_extractor=False)
+        data = Counter()
+        total = sum(features._total for features in features_list)
 
-class TokenSeries(MixinFeaturesDict, Features):
-    def __init__(self, extractor, entries, total):
+        for features in features_list:
+            for k, v in features._entries.items():
+                data[k] += v * features._total/total
+
+        return cls(features_list[0]._extractor, data, total)
+
+    def to_arrays(self):
+        return {
+            'keys': numpy.array(list(self._entries.keys())),
+            'values': numpy.array(list(self._entries.values()), dtype=numpy.float64),
+            'total': numpy.array(self._total)}
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        entries = Counter(dict(zip(arrays['keys'].tolist(), arrays['values'].tolist())))
+        return cls(extractor, entries, arrays['total'].item())
+
+
+# positions of all tokens in one array, grouped by token like a CSR matrix row:
+# positions[offsets[i]:offsets[i+1]] are those of keys[i]
+class TokenSeries(Features):
+    def __init__(self, extractor, keys, offsets, positions, total):
         self._extractor = extractor
-        self._entries = entries
+        self._keys = numpy.asarray(keys)
+        self._offsets = numpy.asanyarray(offsets)
+        self._positions = numpy.asanyarray(positions)
         self._total = total
+        self._index = None
+
+    @classmethod
+    def from_dict(cls, extractor, entries, total):
+        lengths = [len(v) for v in entries.values()]
+        positions = [x for v in entries.values() for x in v]
+        return cls(extractor, list(entries.keys()),
+            numpy.cumsum([0] + lengths, dtype=numpy.int64),
+            numpy.array(positions, dtype=_positions_dtype(total)), total)
+
+    @classmethod
+    def from_ids(cls, extractor, ids, keys=None):
+        # keys[i] is the token with id i, or the ids themselves if not given
+        order = numpy.argsort(ids, kind='stable')
+        counts = numpy.bincount(ids) if len(ids) > 0 else numpy.zeros(0, dtype=numpy.int64)
+        present = numpy.flatnonzero(counts)
+        offsets = numpy.zeros(len(present) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts[present], out=offsets[1:])
+        if keys is not None:
+            present = numpy.asarray(keys)[present]
+        return cls(extractor, present, offsets, order.astype(_positions_dtype(len(ids))), len(ids))
+
+    def extractor(self):
+        return self._extractor
+
+    def total_counts(self):
+        return self._total
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _index_of(self, key):
+        if self._index is None:
+            self._index = dict(zip(self._keys.tolist(), range(len(self._keys))))
+        return self._index[key]
+
+    def positions(self, key):
+        # a view into the shared array, no copies
+        i = self._index_of(key)
+        return self._positions[self._offsets[i]:self._offsets[i+1]]
+
+    def __getitem__(self, key):
+        return self.positions(key).tolist()
+
+    def keys(self):
+        return self._keys.tolist()
+
+    def values(self):
+        return (self[key] for key in self.keys())
+
+    def items(self):
+        return ((key, self[key]) for key in self.keys())
+
+    def __contains__(self, key):
+        try:
+            self._index_of(key)
+            return True
+        except KeyError:
+            return False
+
+    def __eq__(self, other):
+        return list(sorted(self.items())) == list(sorted(other.items()))
+
+    def __ne__(self, other):
+        return not (self == other)
 
     def combine(self, other):
-        if self._extractor != other._extractor:
-            raise TypeError("can not combine features from different extractors")
+        return self.combine_all([self, other])
 
-        data = defaultdict(list)
-        total = self._total + other._total
+    @classmethod
+    def combine_all(cls, features_list):
+        # positions of each one shifted by the totals before it, then regrouped by key
+        features_list = _check_combinable(features_list)
+        extractor = features_list[0]._extractor
+        shifts = numpy.cumsum([0] + [f._total for f in features_list])
+        total = int(shifts[-1])
+        features_list = [(f, shift) for f, shift in zip(features_list, shifts) if len(f) > 0]
+        if len(features_list) == 0:
+            return cls.from_dict(extractor, {}, total)
+
+        keys, inverse = numpy.unique(
+            numpy.concatenate([f._keys for f, _ in features_list]), return_inverse=True)
+        groups = []
+        positions = []
+        start = 0
+        for f, shift in features_list:
+            lengths = numpy.diff(f._offsets)
+            groups.append(numpy.repeat(inverse[start:start + len(f)], lengths))
+            positions.append(f._positions.astype(numpy.int64) + shift)
+            start += len(f)
+
+        groups = numpy.concatenate(groups)
+        order = numpy.argsort(groups, kind='stable')
+        offsets = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(groups, minlength=len(keys)), out=offsets[1:])
+        positions = numpy.concatenate(positions)[order].astype(_positions_dtype(total))
+
+        return cls(extractor, keys, offsets, positions, total)
+
+    def to_arrays(self):
+        return {'keys': self._keys, 'offsets': self._offsets,
+            'positions': self._positions, 'total': numpy.array(self._total)}
 
-        for k, v in self._entries.items():
-            data[k].extend(v)
-        for k, v in other._entries.items():
-            data[k].extend(x + self._total for x in v)
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        return cls(extractor, arrays['keys'], arrays['offsets'],
+            arrays['positions'], arrays['total'].item())
 
-        return self.__class__(self._extractor, data, total)
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, array in self.to_arrays().items():
+            numpy.save(os.path.join(path, name + '.npy'), array, allow_pickle=False)
+
+    @classmethod
+    def load(cls, extractor, path, mmap_mode='r'):
+        # positions are memory mapped, so they are only read as they are used
+        arrays = {}
+        for name in ['keys', 'offsets', 'positions', 'total']:
+            mode = mmap_mode if name in ('offsets', 'positions') else None
+            arrays[name] = numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mode, allow_pickle=False)
+        return cls.from_arrays(extractor, arrays)
+
+
+def _positions_dtype(total):
+    return numpy.int32 if total < 2**31 else numpy.int64
 
 
 class TokenEntropies(MixinFeaturesDict, Features):
@@ -141,7 +337,307 @@ class TokenEntropies(MixinFeaturesDict, Features):
 
         return self.__class__(self._extractor, sum_freqs, sum_freqs_log, total)
 
+    @classmethod
+    def combine_all(cls, features_list):
+        features_list = _check_combinable(features_list, same_extractor=False)
+        total = 0
+        sum_freqs = Counter()
+        sum_freqs_log = Counter()
+
+        for features in features_list:
+            for k in features._sum_freqs.keys():
+                sum_freqs[k] += features._sum_freqs[k]
+                sum_freqs_log[k] += features._sum_freqs_log[k]
+            total += features._total
+
+        return cls(features_list[0]._extractor, sum_freqs, sum_freqs_log, total)
+
+    def to_arrays(self):
+        keys = list(self._sum_freqs.keys())
+        return {
+            'keys': numpy.array(keys),
+            'sum_freqs': numpy.array([self._sum_freqs[k] for k in keys], dtype=numpy.float64),
+            'sum_freqs_log': numpy.array([self._sum_freqs_log[k] for k in keys], dtype=numpy.float64),
+            'total': numpy.array(self._total)}
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        keys = arrays['keys'].tolist()
+        sum_freqs = Counter(dict(zip(keys, arrays['sum_freqs'].tolist())))
+        sum_freqs_log = Counter(dict(zip(keys, arrays['sum_freqs_log'].tolist())))
+        return cls(extractor, sum_freqs, sum_freqs_log, arrays['total'].item())
+
     def __getitem__(self, key):
         # FIXME: remove word or return 1 instead of adjusting; add test
         coeff = -1 / (math.log(self._total) * self._sum_freqs[key] + 10**-300)
         return coeff * (self._sum_freqs_log[key] - self._sum_freqs[key]*math.log(self._sum_freqs[key]))
+
+    def values_for(self, keys):
+        # same as [self[k] for k in keys], as an array; unknown keys give nan
+        keys = list(keys)
+        sum_freqs = numpy.fromiter((self._sum_freqs[k] for k in keys), dtype=numpy.float64, count=len(keys))
+        sum_freqs_log = numpy.fromiter((self._sum_freqs_log[k] for k in keys), dtype=numpy.float64, count=len(keys))
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            coeff = -1 / (math.log(self._total) * sum_freqs + 10**-300)
+            return coeff * (sum_freqs_log - sum_freqs*numpy.log(sum_freqs))
+
+
+# same interface as MixinFeaturesDict, over a sorted array of keys (usually
+# token ids) and arrays of values, so that combining is vectorized
+class MixinFeaturesArrays:
+    def extractor(self):
+        return self._extractor
+
+    def total_counts(self):
+        return self._total
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _index_of(self, key):
+        i = numpy.searchsorted(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        return self.values_array()[self._index_of(key)].item()
+
+    def keys(self):
+        return self._keys.tolist()
+
+    def values(self):
+        return self.values_array().tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def __contains__(self, key):
+        try:
+            self._index_of(key)
+            return True
+        except KeyError:
+            return False
+
+    def keys_array(self):
+        return self._keys
+
+    def values_array(self):
+        raise NotImplementedError()
+
+    def __eq__(self, other):
+        return list(sorted(self.items())) == list(sorted(other.items()))
+
+    def __ne__(self, other):
+        return not (self == other)
+
+
+def _sorted_keys(keys):
+    keys = numpy.asarray(keys)
+    if len(keys) == 0:
+        keys = keys.astype(numpy.int32)
+    return keys
+
+
+def _merge_arrays(keys_list, values_lists):
+    # union of the keys, adding up the values of each list for repeated keys
+    keys, inverse = numpy.unique(numpy.concatenate(keys_list), return_inverse=True)
+    merged = []
+    for values in values_lists:
+        merged.append(numpy.bincount(inverse, weights=numpy.concatenate(values), minlength=len(keys)))
+    return keys, merged
+
+
+class ArrayTokenVocabularies(MixinFeaturesArrays, Features):
+    def __init__(self, extractor, keys):
+        self._extractor = extractor
+        self._keys = _sorted_keys(keys)
+        self._total = len(self._keys)
+
+    def values_array(self):
+        return numpy.ones(len(self._keys), dtype=bool)
+
+    def combine(self, other):
+        if self._extractor != other._extractor:
+            raise TypeError("can not combine features from different extractors")
+
+        return self.__class__(self._extractor, numpy.union1d(self._keys, other._keys))
+
+    @classmethod
+    def combine_all(cls, features_list):
+        features_list = _check_combinable(features_list)
+        keys = numpy.unique(numpy.concatenate([features._keys for features in features_list]))
+        return cls(features_list[0]._extractor, keys)
+
+    def to_arrays(self):
+        return {'keys': self._keys}
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        return cls(extractor, numpy.unique(arrays['keys']))
+
+
+class ArrayTokenFrequencies(MixinFeaturesArrays, Features):
+    def __init__(self, extractor, keys, values, total):
+        self._extractor = extractor
+        self._keys = _sorted_keys(keys)
+        self._values = numpy.asarray(values, dtype=numpy.float64)
+        self._total = total
+
+    def __getitem__(self, key):
+        # like the Counter in TokenFrequencies
+        try:
+            return self._values[self._index_of(key)].item()
+        except KeyError:
+            return 0
+
+    def values_array(self):
+        return self._values
+
+    def combine(self, other):
+        total = self._total + other._total
+        keys, (values,) = _merge_arrays(
+            [self._keys, other._keys],
+            [[self._values * self._total/total, other._values * other._total/total]])
+        return self.__class__(self._extractor, keys, values, total)
+
+    @classmethod
+    def combine_all(cls, features_list):
+        features_list = _check_combinable(features_list, same_extractor=False)
+        total = sum(features._total for features in features_list)
+        keys, (values,) = _merge_arrays(
+            [features._keys for features in features_list],
+            [[features._values * features._total/total for features in features_list]])
+        return cls(features_list[0]._extractor, keys, values, total)
+
+    def to_arrays(self):
+        return {'keys': self._keys, 'values': self._values, 'total': numpy.array(self._total)}
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        order = numpy.argsort(arrays['keys'], kind='stable')
+        return cls(extractor, numpy.asarray(arrays['keys'])[order],
+            arrays['values'][order], arrays['total'].item())
+
+
+class ArrayTokenEntropies(MixinFeaturesArrays, Features):
+    def __init__(self, extractor, keys, sum_freqs, sum_freqs_log, total):
+        self._extractor = extractor
+        self._keys = _sorted_keys(keys)
+        self._sum_freqs = numpy.asarray(sum_freqs, dtype=numpy.float64)
+        self._sum_freqs_log = numpy.asarray(sum_freqs_log, dtype=numpy.float64)
+        self._total = total
+        self._entropies = None
+
+    @classmethod
+    def from_dicts(cls, extractor, sum_freqs, sum_freqs_log, total):
+        keys = numpy.array(sorted(sum_freqs.keys()), dtype=numpy.int64)
+        return cls(extractor, keys,
+            [sum_freqs[k] for k in keys.tolist()], [sum_freqs_log[k] for k in keys.tolist()], total)
+
+    def values_array(self):
+        if self._entropies is None:
+            self._entropies = numpy.empty(0)
+            if len(self._keys) > 0:
+                # FIXME: same adjustment as TokenEntropies
+                coeff = -1 / (math.log(self._total) * self._sum_freqs + 10**-300)
+                self._entropies = coeff * (self._sum_freqs_log - self._sum_freqs*numpy.log(self._sum_freqs))
+        return self._entropies
+
+    def values_for(self, keys):
+        # unknown keys give nan, like TokenEntropies.values_for
+        keys = numpy.asarray(keys)
+        indices = numpy.minimum(numpy.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        result = numpy.full(len(keys), numpy.nan)
+        if len(self._keys) > 0:
+            found = self._keys[indices] == keys
+            result[found] = self.values_array()[indices[found]]
+        return result
+
+    def combine(self, other):
+        total = self._total + other._total
+        keys, (sum_freqs, sum_freqs_log) = _merge_arrays(
+            [self._keys, other._keys],
+            [[self._sum_freqs, other._sum_freqs], [self._sum_freqs_log, other._sum_freqs_log]])
+        return self.__class__(self._extractor, keys, sum_freqs, sum_freqs_log, total)
+
+    @classmethod
+    def combine_all(cls, features_list):
+        features_list = _check_combinable(features_list, same_extractor=False)
+        keys, (sum_freqs, sum_freqs_log) = _merge_arrays(
+            [features._keys for features in features_list],
+            [[features._sum_freqs for features in features_list],
+             [features._sum_freqs_log for features in features_list]])
+        total = sum(features._total for features in features_list)
+        return cls(features_list[0]._extractor, keys, sum_freqs, sum_freqs_log, total)
+
+    def to_arrays(self):
+        return {'keys': self._keys, 'sum_freqs': self._sum_freqs,
+            'sum_freqs_log': self._sum_freqs_log, 'total': numpy.array(self._total)}
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        order = numpy.argsort(arrays['keys'], kind='stable')
+        return cls(extractor, numpy.asarray(arrays['keys'])[order],
+            arrays['sum_freqs'][order], arrays['sum_freqs_log'][order], arrays['total'].item())
+
+
+class MultiFeatures(Features):
+    def __init__(self, extractor, features):
+        self._extractor = extractor
+        self._features = features
+
+    def extractor(self):
+        return self._extractor
+
+    def combine(self, other):
+        if self.names() != other.names():
+            raise TypeError("can not combine features from different extractors")
+
+        features = {}
+        for name in self.names():
+            features[name] = self[name].combine(other[name])
+        return self.__class__(self._extractor, features)
+
+    @classmethod
+    def combine_all(cls, features_list):
+        features_list = _check_combinable(features_list, same_extractor=False)
+        first = features_list[0]
+        if any(features.names() != first.names() for features in features_list):
+            raise TypeError("can not combine features from different extractors")
+
+        features = {}
+        for name in first.names():
+            features[name] = type(first[name]).combine_all([f[name] for f in features_list])
+        return cls(first._extractor, features)
+
+    def __getitem__(self, name):
+        return self._features[name]
+
+    def names(self):
+        return self._features.keys()
+
+    def to_arrays(self):
+        arrays = {}
+        for name, features in self._features.items():
+            arrays['%s/kind' % name] = numpy.array(features.__class__.__name__)
+            for k, v in features.to_arrays().items():
+                arrays['%s/%s' % (name, k)] = v
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, extractor, arrays):
+        features = {}
+        for name in extractor.names():
+            prefix = '%s/' % name
+            component = dict((k[len(prefix):], v) for k, v in arrays.items() if k.startswith(prefix))
+            kind = getattr(bc, component.pop('kind').item())
+            features[name] = kind.from_arrays(extractor.extractor_for(name), component)
+        return cls(extractor, features)
+
+    def __eq__(self, other):
+        return self._features == other._features
+
+    def __ne__(self, other):
+        return not (self == other)
@@ -1,4 +1,14 @@
+import re
 import nltk
+import numpy
+import book_classification as bc
+
+# recent versions of nltk compile their patterns with the regex module
+try:
+    from nltk import redos
+    import regex as _nltk_engine
+except ImportError:
+    _nltk_engine = re
 
 
 class Tokenizer:
@@ -25,19 +35,112 @@ class BasicTokenizer(Tokenizer):
         return filter(is_word, tokens)
 
 
+class FastTokenizer(Tokenizer):
+    # same tokens as BasicTokenizer: wordpunct_tokenize splits on \w+ runs, and only
+    # runs made of letters and longer than 2 survive the filter; \w has to be that
+    # of the engine nltk matches with, which is not the same as re's
+    _pattern = _nltk_engine.compile(r'\w{3,}')
+
+    def tokens_from(self, book):
+        text = book.contents().lower()
+        tokens = map(_nltk_engine.Match.group, self._pattern.finditer(text))
+        # runs with digits, underscores or other non-letters are dropped here
+        return filter(str.isalpha, tokens)
+
+
+# same tokens as FastTokenizer, from the text read a chunk at a time; only
+# the current chunk is ever lowercased and matched, not the whole book
+class StreamingTokenizer(Tokenizer):
+    def __init__(self, chunk_size=2**16):
+        self._chunk_size = chunk_size
+
+    def tokens_from(self, book):
+        for piece in self.pieces_from(book):
+            tokens = map(_nltk_engine.Match.group, FastTokenizer._pattern.finditer(piece.lower()))
+            yield from filter(str.isalpha, tokens)
+
+    def pieces_from(self, book):
+        if hasattr(book, 'text_chunks'):
+            chunks = book.text_chunks(self._chunk_size)
+        else:
+            chunks = iter([book.contents()])
+
+        # pieces end right after a space or a newline: no token goes across them,
+        # and lower() needs nothing after them to pick a final sigma
+        carry = ''
+        for chunk in chunks:
+            text = carry + chunk
+            cut = max(text.rfind(' '), text.rfind('\n')) + 1
+            if cut > 0:
+                yield text[:cut]
+            carry = text[cut:]
+        if carry:
+            yield carry
+
+
+# emits a numpy array of token ids instead of strings, extractors count it with numpy
+class InterningTokenizer(Tokenizer):
+    def __init__(self, tokenizer, interner=None):
+        self._tokenizer = tokenizer
+        self._interner = interner
+        if self._interner is None:
+            self._interner = bc.TokenInterner()
+
+    def tokens_from(self, book):
+        return self._interner.intern_all(self._tokenizer.tokens_from(book))
+
+    def interner(self):
+        return self._interner
+
+
+# which ids of an interner are words of a vocabulary, as a boolean table indexed
+# by id; only words not seen yet are looked up again when the interner grows
+class VocabularyMask:
+    def __init__(self, vocabulary):
+        self._vocabulary = vocabulary
+        self._interner = None
+
+    def mask_for(self, interner):
+        if interner is not self._interner:
+            self._interner = interner
+            self._mask = numpy.zeros(0, dtype=bool)
+            self._missing = list(self._vocabulary)
+
+        if len(self._mask) < len(interner):
+            mask = numpy.zeros(len(interner), dtype=bool)
+            mask[:len(self._mask)] = self._mask
+            ids = interner.lookup_all(self._missing)
+            mask[ids[ids >= 0]] = True
+            self._missing = [word for word, index in zip(self._missing, ids) if index < 0]
+            self._mask = mask
+        return self._mask
+
+    def fingerprint_state(self):
+        # the table only caches what the vocabulary says
+        return self._vocabulary
+
+
+# both work on strings, or on arrays of ids from an InterningTokenizer
 class FilteringTokenizer(Tokenizer):
     def __init__(self, tokenizer, vocabulary):
         self._tokenizer = tokenizer
         self._vocabulary = set(vocabulary)
+        self._mask = VocabularyMask(self._vocabulary)
 
     def tokens_from(self, book):
-        func = lambda x: x in self._vocabulary
         tokens = self._tokenizer.tokens_from(book)
+        if isinstance(tokens, numpy.ndarray):
+            return tokens[self._mask.mask_for(self.interner())[tokens]]
+
+        func = lambda x: x in self._vocabulary
         return filter(func, tokens)
 
     def vocabulary(self):
         return self._vocabulary
 
+    def interner(self):
+        return interner_of(self._tokenizer)
+
 
 class TransformingTokenizer(Tokenizer):
     def __init__(self, tokenizer, transform):
@@ -55,12 +158,30 @@ class CollapsingTokenizer(Tokenizer):
         self._tokenizer = tokenizer
         self._vocabulary = set(vocabulary)
         self._null = null
+        self._mask = VocabularyMask(self._vocabulary)
 
         assert(self._null not in self._vocabulary)
 
     def tokens_from(self, book):
+        tokens = self._tokenizer.tokens_from(book)
+        if isinstance(tokens, numpy.ndarray):
+            interner = self.interner()
+            null = interner.intern(self._null)
+            mask = self._mask.mask_for(interner)
+            return numpy.where(mask[tokens], tokens, numpy.int32(null))
+
         convert = lambda x: x if x in self._vocabulary else self._null
-        return map(convert, self._tokenizer.tokens_from(book))
+        return map(convert, tokens)
 
     def vocabulary(self):
         return self._vocabulary
+
+    def interner(self):
+        return interner_of(self._tokenizer)
+
+
+# None for tokenizers emitting strings
+def interner_of(tokenizer):
+    if hasattr(tokenizer, 'interner'):
+        return tokenizer.interner()
+    return None
@@ -1,4 +1,9 @@
 import random
+import hashlib
+import uuid
+import types
+from collections import defaultdict
+import numpy
 
 
 class RandomContext:
@@ -7,10 +12,19 @@ class RandomContext:
 
     def __enter__(self):
         self._oldstate = random.getstate()
+        self._oldstate_numpy = numpy.random.get_state()
         random.seed(self._seed)
+        # numpy's global generator too, used by sklearn when random_state is None
+        numpy.random.seed(self._numpy_seed())
 
     def __exit__(self, exc_type, exc_value, traceback):
         random.setstate(self._oldstate)
+        numpy.random.set_state(self._oldstate_numpy)
+
+    def _numpy_seed(self):
+        if isinstance(self._seed, int):
+            return self._seed % 2**32
+        return int(hashlib.sha1(repr(self._seed).encode('utf-8')).hexdigest()[:8], 16)
 
 
 class NumericIndexer:
@@ -44,3 +58,130 @@ class NumericIndexer:
 
     def vocabulary(self):
         return self._objects
+
+
+class TokenInterner:
+    def __init__(self, tokens=()):
+        self._reset([])
+        self.intern_all(tokens)
+
+    def _reset(self, words, identity=None):
+        # unseen tokens get the next free id, i.e. the current size
+        self._indices = defaultdict()
+        self._indices.default_factory = self._indices.__len__
+        self._indices.update(zip(words, range(len(words))))
+        self._words = list(words)
+        # ids only make sense within one interner (and its pickled copies)
+        self._identity = identity or uuid.uuid4().hex
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __contains__(self, token):
+        return token in self._indices
+
+    def intern(self, token):
+        return self._indices[token]
+
+    def intern_all(self, tokens):
+        return numpy.fromiter(map(self._indices.__getitem__, tokens), dtype=numpy.int32)
+
+    def lookup_all(self, tokens):
+        # like intern_all, but unknown tokens map to -1 instead of being added
+        get = self._indices.get
+        return numpy.fromiter((get(token, -1) for token in tokens), dtype=numpy.int32)
+
+    def decode(self, index):
+        return self.words()[index]
+
+    def decode_all(self, indices):
+        words = self.words()
+        return [words[index] for index in indices]
+
+    def decode_items(self, items):
+        words = self.words()
+        for index, value in items:
+            yield words[index], value
+
+    def words(self):
+        # dicts keep insertion order, which is also id order
+        if len(self._words) != len(self._indices):
+            self._words = list(self._indices)
+        return self._words
+
+    def fingerprint_state(self):
+        return self._identity
+
+    def __getstate__(self):
+        return {'words': self.words(), 'identity': self._identity}
+
+    def __setstate__(self, state):
+        self._reset(state['words'], state['identity'])
+
+
+# 64 bits of a token that are the same in every run, unlike hash()
+def stable_hash(token):
+    return int.from_bytes(hashlib.blake2b(str(token).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# stable_hash of every token, each distinct token hashed once; ids from an
+# InterningTokenizer are decoded through its interner first, so the hashes
+# don't depend on the order words were interned in
+def token_hashes(tokens, interner=None):
+    if isinstance(tokens, numpy.ndarray):
+        if interner is None:
+            return tokens.astype(numpy.uint64)
+        ids, inverse = numpy.unique(tokens, return_inverse=True)
+        words = interner.decode_all(ids.tolist())
+    else:
+        indices = {}
+        inverse = numpy.fromiter((indices.setdefault(t, len(indices)) for t in tokens), dtype=numpy.int64)
+        words = indices
+    hashes = numpy.fromiter(map(stable_hash, words), dtype=numpy.uint64, count=len(words))
+    return hashes[inverse]
+
+
+# stable across processes and runs, unlike hash(); objects can provide
+# fingerprint_state() to say what matters about them
+def fingerprint(obj):
+    return hashlib.sha1(repr(_fingerprint_description(obj)).encode('utf-8')).hexdigest()
+
+
+def _cell_contents(cell):
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None
+
+
+def _fingerprint_description(obj):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [type(obj).__name__] + [_fingerprint_description(x) for x in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted(repr(_fingerprint_description(x)) for x in obj)
+    if isinstance(obj, dict):
+        return sorted((repr(_fingerprint_description(k)), repr(_fingerprint_description(v)))
+            for k, v in obj.items())
+    if isinstance(obj, numpy.ndarray):
+        return ['ndarray', str(obj.dtype), obj.shape, hashlib.sha1(obj.tobytes()).hexdigest()]
+    if isinstance(obj, types.FunctionType):
+        # closures and defaults are configuration as much as the code is
+        code = obj.__code__
+        return [obj.__module__, obj.__qualname__, code.co_code, repr(code.co_consts),
+            [_fingerprint_description(_cell_contents(cell)) for cell in obj.__closure__ or ()],
+            _fingerprint_description(obj.__defaults__),
+            _fingerprint_description(obj.__kwdefaults__)]
+    if isinstance(obj, types.MethodType):
+        return ['method', _fingerprint_description(obj.__func__), _fingerprint_description(obj.__self__)]
+    if isinstance(obj, types.BuiltinMethodType) and not isinstance(obj.__self__, (types.ModuleType, type(None))):
+        # like str.lower bound to a string, whose repr has an address in it
+        return ['builtin method', obj.__qualname__, _fingerprint_description(obj.__self__)]
+
+    name = '%s.%s' % (type(obj).__module__, type(obj).__qualname__)
+    if hasattr(obj, 'fingerprint_state'):
+        return [name, _fingerprint_description(obj.fingerprint_state())]
+    if hasattr(obj, '__dict__'):
+        return [name, _fingerprint_description(vars(obj))]
+    return [name, repr(obj)]